@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the hot paths of django_staticstorages.
+
+Generates a synthetic static tree and measures post_process throughput,
+url() latency with a cold and a warm manifest, manifest load and storage
+warm-up time and peak memory. Results are written as JSON, so runs of
+different commits can be compared::
+
+    python benchmarks/bench.py --files 2000 --output before.json
+"""
+import argparse
+import json
+import os
+import platform
+import posixpath
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--files', type=int, default=1000,
+                        help='number of files in the tree')
+    parser.add_argument('--css-ratio', type=float, default=0.2,
+                        help='share of css files')
+    parser.add_argument('--js-ratio', type=float, default=0.2,
+                        help='share of js files')
+    parser.add_argument('--references', type=int, default=5,
+                        help='references per css/js file')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='maximum nesting depth of directories')
+    parser.add_argument('--file-size', type=int, default=2048,
+                        help='approximate size of every file in bytes')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='STATICFILES_POST_PROCESS_WORKERS')
+    parser.add_argument('--format', choices=('json', 'binary'), default='json',
+                        help='STATIC_CACHE_FORMAT')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of every measurement, the best one is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write the results to '
+                        '(stdout by default)')
+    parser.add_argument('--baseline', help='results of an earlier run to '
+                        'compare with, the ratios are printed to stderr')
+    return parser.parse_args(argv)
+
+
+def generate_tree(root, options):
+    """
+    Writes ``options.files`` files under ``root`` and returns their names.
+    css and js files only refer to files generated before them, so the
+    tree has no reference cycles.
+    """
+    rnd = random.Random(options.seed)
+    names = []
+    for index in xrange(options.files):
+        depth = rnd.randint(0, options.depth)
+        directory = '/'.join('d%d' % rnd.randint(0, 9) for _ in xrange(depth))
+        kind = rnd.random()
+        if kind < options.css_ratio:
+            ext = '.css'
+        elif kind < options.css_ratio + options.js_ratio:
+            ext = '.js'
+        else:
+            ext = rnd.choice(('.png', '.txt', '.svg'))
+        name = posixpath.join(directory, 'f%d%s' % (index, ext))
+        lines = []
+        if ext in ('.css', '.js') and names:
+            for target in rnd.sample(names, min(options.references, len(names))):
+                url = posixpath.relpath(target, posixpath.dirname(name) or '.')
+                if ext == '.css':
+                    lines.append('.c%d { background: url("%s"); }' % (len(lines), url))
+                else:
+                    lines.append('var c%d = \'url("%s")\';' % (len(lines), url))
+        filler = '/* %s */' % ('x' * 60)
+        while sum(len(line) + 1 for line in lines) < options.file_size:
+            lines.append(filler)
+        path = os.path.join(root, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write('\n'.join(lines))
+        names.append(name)
+    return names
+
+
+def configure(tmpdir, options):
+    from django.conf import settings
+    settings.configure(
+        DEBUG=False,
+        STATIC_URL='/static/',
+        STATIC_ROOT=os.path.join(tmpdir, 'root'),
+        STATIC_CACHE_FILE=os.path.join(tmpdir, 'static.json'),
+        STATIC_CACHE_FORMAT=options.format,
+        STATIC_CACHE_RELOAD_INTERVAL=None,
+        STATICFILES_POST_PROCESS_WORKERS=options.workers,
+    )
+
+
+def best_of(repeat, setup, run):
+    """
+    Calls ``setup`` and times ``run`` with its result ``repeat`` times,
+    and returns the fastest time in seconds.
+    """
+    timings = []
+    for _ in xrange(repeat):
+        arg = setup()
+        start = time.time()
+        run(arg)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def peak_memory_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    if sys.platform == 'darwin':
+        usage /= 1024
+    return usage
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    tmpdir = tempfile.mkdtemp(prefix='staticstorages-bench-')
+    try:
+        source_root = os.path.join(tmpdir, 'src')
+        names = generate_tree(source_root, options)
+        configure(tmpdir, options)
+
+        from django.core.files.storage import FileSystemStorage
+        from django_staticstorages import HashedCache, HashedFilesStorage
+
+        source = FileSystemStorage(source_root)
+        paths = dict((name.replace('/', os.sep), (source, name.replace('/', os.sep)))
+                     for name in names)
+        results = {}
+
+        def post_process(storage):
+            for _ in storage.post_process(paths):
+                pass
+
+        def fresh_storage():
+            # the originals as collectstatic copies them before post_process
+            shutil.rmtree(os.path.join(tmpdir, 'root'), ignore_errors=True)
+            shutil.copytree(source_root, os.path.join(tmpdir, 'root'))
+            return HashedFilesStorage()
+
+        seconds = best_of(options.repeat, fresh_storage, post_process)
+        tree_size = sum(os.path.getsize(os.path.join(source_root, name))
+                        for name in names)
+        results['post_process'] = {
+            'seconds': seconds,
+            'files_per_second': len(names) / seconds,
+            'megabytes_per_second': tree_size / seconds / 2 ** 20,
+            'peak_memory_kb': peak_memory_kb(),
+        }
+
+        seconds = best_of(options.repeat, lambda: None, lambda _: HashedCache())
+        results['manifest_load'] = {
+            'seconds': seconds,
+            'size_bytes': os.path.getsize(os.path.join(tmpdir, 'static.json')),
+        }
+
+        seconds = best_of(options.repeat, lambda: None,
+                          lambda _: HashedFilesStorage().warm())
+        results['storage_warm'] = {'seconds': seconds}
+
+        def urls(storage):
+            for name in names:
+                storage.url(name)
+
+        def cold_storage():
+            # nothing in the manifest, every name is hashed on the miss
+            storage = HashedFilesStorage()
+            storage.cache.clear()
+            storage.cache.set = lambda key, value: storage.cache.update({key: value})
+            return storage
+
+        for label, setup in (('cold', cold_storage),
+                             ('warm', HashedFilesStorage)):
+            seconds = best_of(options.repeat, setup, urls)
+            results['url_%s' % label] = {
+                'seconds': seconds,
+                'microseconds_per_call': seconds / len(names) * 1e6,
+            }
+        results['peak_memory_kb'] = peak_memory_kb()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': vars(options),
+        'results': results,
+    }
+
+
+def compare(baseline, results):
+    """
+    Yields (measurement, baseline value, value, value / baseline value)
+    for every number both result sets have.
+    """
+    for section, values in sorted(results.iteritems()):
+        if not isinstance(values, dict):
+            values = {'': values}
+        for key, value in sorted(values.iteritems()):
+            previous = baseline.get(section)
+            if key:
+                previous = (previous or {}).get(key)
+            if previous:
+                yield '.'.join(filter(None, (section, key))), previous, value, \
+                    float(value) / previous
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    results = run(options)
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+        for measurement, previous, value, ratio in compare(
+                baseline, results['results']):
+            sys.stderr.write('%-40s %12.6g %12.6g %8.3fx\n' % (
+                measurement, previous, value, ratio))
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+
+if __name__ == '__main__':
+    main()
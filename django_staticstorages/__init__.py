@@ -1,40 +1,493 @@
+import atexit
+import base64
+import binascii
+import errno
 import fnmatch
 import functools
+import gzip
 import hashlib
+import itertools
 import json
+import logging
+import mimetypes
+import mmap
 import os.path
 import posixpath
 import re
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 from urllib import unquote
 from urlparse import urlsplit, urlunsplit, urldefrag
 
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile, File
 from django.core.files.storage import get_storage_class
+from django.dispatch import Signal
 from django.contrib.staticfiles.storage import StaticFilesStorage
 from django.utils.encoding import smart_str, force_unicode
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import pyblake2
+except ImportError:
+    pyblake2 = None
+
+
+logger = logging.getLogger('django_staticstorages')
+
+# sent by HashedFilesStorage.post_process once the manifest is saved
+post_processed = Signal(providing_args=['storage', 'stats'])
 
 DEFAULT_HASHED_PROCESSORS = (
     'django_staticstorages.JsProcessor',
     'django_staticstorages.CssProcessor',
 )
 
+DEFAULT_COMPRESS_PATTERNS = (
+    '*.css', '*.js', '*.map', '*.json', '*.svg', '*.html', '*.txt',
+    '*.xml', '*.ico', '*.eot', '*.ttf', '*.otf',
+)
+
+DEFAULT_INLINE_TYPES = (
+    'image/png', 'image/gif', 'image/jpeg', 'image/svg+xml', 'image/webp',
+)
+
+
+def atomic_write(filename, write):
+    """
+    Calls ``write`` with a temporary file next to ``filename`` and renames
+    it over ``filename``, so readers never see a truncated file.
+    """
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix='.%s.' % os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            write(tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_filename, 0644)
+        os.rename(tmp_filename, filename)
+    except:
+        os.unlink(tmp_filename)
+        raise
+
+
+class file_lock(object):
+    """
+    Holds an exclusive, or a ``shared``, lock on ``filename`` for the
+    duration of a with block, where fcntl is available.
+    """
+
+    def __init__(self, filename, shared=False):
+        self.filename = filename
+        self.shared = shared
+        self.lock_file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.lock_file = open(self.filename, 'a')
+            fcntl.flock(self.lock_file.fileno(),
+                        fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+
+def gzip_compress(content):
+    buf = StringIO()
+    # no name and a zero mtime, so that equal content compresses to
+    # equal bytes
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf,
+                       compresslevel=9, mtime=0) as gz:
+        gz.write(content)
+    return buf.getvalue()
+
+
+def brotli_compress(content):
+    return brotli.compress(content)
+
+
+# extensions of the compressed variants, by STATICFILES_COMPRESS_FORMATS
+COMPRESSORS = {
+    'gz': gzip_compress,
+    'br': brotli_compress,
+}
+
+
+def new_hash(algorithm):
+    """
+    Returns a new hash object of ``algorithm``, any algorithm hashlib
+    supports, or blake2b and blake2s if pyblake2 is installed.
+    """
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        if pyblake2 is not None and algorithm in ('blake2b', 'blake2s'):
+            return getattr(pyblake2, algorithm)()
+        raise ImproperlyConfigured("Unsupported hash algorithm %r" % algorithm)
+
+
+class MultiHash(object):
+    """
+    Hashes the same data with several algorithms at once. The first one
+    names files, the optional second one gives their Subresource
+    Integrity value.
+    """
+
+    def __init__(self, algorithms):
+        self.algorithms = algorithms
+        self.hashes = [new_hash(algorithm) for algorithm in algorithms]
+
+    def update(self, data):
+        for hash_object in self.hashes:
+            hash_object.update(data)
+
+    def hexdigest(self):
+        return self.hashes[0].hexdigest()
+
+    def integrity(self):
+        if len(self.hashes) < 2:
+            return None
+        return '%s-%s' % (self.algorithms[1],
+                          base64.b64encode(self.hashes[1].digest()))
+
+
+class ChunkedContent(object):
+    """
+    Content given as an iterable of chunks, which can be read once.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    def chunks(self):
+        return iter(self._chunks)
+
+
+def hash_chunks(chunks, hasher):
+    """
+    Yields ``chunks``, updating ``hasher`` with every one of them.
+    """
+    for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+
+class CyclicReferenceWarning(RuntimeWarning):
+    pass
+
+
+def sort_references(graph):
+    """
+    Orders ``graph``, a mapping of names to the names they refer to, so
+    that every name comes after the names it refers to.
+
+    Returns a list of levels. Each level is a list of strongly connected
+    components (sorted tuples of names) which only refer to components of
+    earlier levels, so the components of one level are independent of each
+    other. A component of more than one name, or of a name referring to
+    itself, is a reference cycle.
+    """
+    index, low, stack, on_stack = {}, {}, [], set()
+    components = []
+    for root in sorted(graph):
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(sorted(graph[root])))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = low[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(sorted(graph[child]))))
+                    break
+                elif child in on_stack:
+                    low[node] = min(low[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(tuple(sorted(component)))
+
+    # Tarjan's algorithm emits a component after everything it refers to
+    levels, level_of = [], {}
+    for component in components:
+        level = 0
+        for member in component:
+            for child in graph[member]:
+                if child not in component:
+                    level = max(level, level_of[child] + 1)
+        for member in component:
+            level_of[member] = level
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(component)
+    return levels
+
+
+def partition_references(graph, count, groups=()):
+    """
+    Splits the names of ``graph``, a mapping of names to the names they
+    refer to, into ``count`` shards which can be post-processed on their
+    own: names which refer to each other, directly or not, and the names
+    of each of ``groups`` end up in the same shard.
+
+    The connected components are dealt out largest first to the smallest
+    shard, which only depends on ``graph``, so every shard computes the
+    same partition. Returns a list of ``count`` sets of names.
+    """
+    parent = dict((name, name) for name in graph)
+
+    def find(name):
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    def union(first, second):
+        first, second = find(first), find(second)
+        if first != second:
+            parent[max(first, second)] = min(first, second)
+
+    for name, references in graph.iteritems():
+        for reference in references:
+            union(name, reference)
+    for group in groups:
+        for name in group[1:]:
+            union(group[0], name)
+    components = {}
+    for name in graph:
+        components.setdefault(find(name), []).append(name)
+    shards = [set() for _ in xrange(count)]
+    for component in sorted(components.values(),
+                            key=lambda component: (-len(component), min(component))):
+        smallest = min(xrange(count), key=lambda index: (len(shards[index]), index))
+        shards[smallest].update(component)
+    return shards
+
+
+class RuleMatch(object):
+    """
+    The groups of one rule within a match of a combined scanner.
+    """
+
+    def __init__(self, match, prefix):
+        self.match = match
+        self.prefix = prefix
+
+    def group(self, name):
+        return self.match.group(self.prefix + name)
+
+    def span(self, name):
+        return self.match.span(self.prefix + name)
+
+    def start(self):
+        return self.match.start()
+
+    def end(self):
+        return self.match.end()
+
+
+def compile_rules(rules):
+    """
+    Compiles ``rules``, a sequence of (pattern, handler name) pairs, into
+    one scanner matching any of the patterns.
+
+    Group names of every pattern are prefixed to keep them apart, so the
+    patterns may only use named groups. Returns the scanner and a mapping
+    of the group name of each rule to its group prefix and handler name.
+    """
+    alternatives, handlers = [], {}
+    for index, (pattern, handler) in enumerate(rules):
+        prefix = 'r%d_' % index
+        pattern = re.sub(r'\(\?P<(\w+)>', r'(?P<%s\1>' % prefix, pattern)
+        pattern = re.sub(r'\(\?P=(\w+)\)', r'(?P=%s\1)' % prefix, pattern)
+        pattern = re.sub(r'\(\?\((\w+)\)', r'(?(%s\1)' % prefix, pattern)
+        alternatives.append('(?P<r%d>%s)' % (index, pattern))
+        handlers['r%d' % index] = (prefix, handler)
+    return re.compile('|'.join(alternatives)), handlers
+
+
 class BaseProcessor(object):
+    # glob patterns of the files to process; a processor may also set a
+    # single ``filepattern``
+    filepatterns = ()
+    # (pattern, handler name) pairs; every pattern captures the URL it
+    # rewrites in the ``url_group`` group
+    rules = ()
+    url_group = 'url'
+    # whether URLs may be inlined as data URIs, see
+    # HashedFilesStorage.data_uri
+    inline_urls = False
+
     def __init__(self, backend):
         self.backend = backend
+        if not self.filepatterns and getattr(self, 'filepattern', None):
+            self.filepatterns = (self.filepattern,)
 
-    def _process_url(self, name, url):
-        # Completely ignore http(s) prefixed URLs,
-        # fragments and data-uri URLs
-        if url.startswith(('#', 'http:', 'https:', 'data:')):
-            return url
+    @property
+    def scanner(self):
+        cls = type(self)
+        if '_scanner' not in cls.__dict__:
+            cls._scanner = compile_rules(self.get_rules())
+        return cls._scanner
+
+    def get_rules(self):
+        """
+        Returns the (pattern, handler name) rules, read when the scanner is
+        first compiled rather than at import time.
+        """
+        return self.rules
+
+    def matches(self, content):
+        """
+        Yields (handler name, match) for every rule match in ``content``,
+        in a single pass over it.
+        """
+        scanner, handlers = self.scanner
+        for match in scanner.finditer(content):
+            prefix, handler = handlers[match.lastgroup]
+            yield handler, RuleMatch(match, prefix)
+
+    def process(self, name, content):
+        output, position = [], 0
+        for handler, match in self.matches(content):
+            output.append(content[position:match.start()])
+            output.append(getattr(self, handler)(name, match))
+            position = match.end()
+        output.append(content[position:])
+        return ''.join(output)
+
+    def scan_chunks(self, chunks):
+        """
+        Yields (None, text) for the text between rule matches and (handler
+        name, match) for every match in the content of ``chunks``, in
+        order. The last STATICFILES_STREAM_OVERLAP bytes of every chunk are
+        scanned again with the next one, so only matches longer than that
+        can be missed at chunk boundaries.
+        """
+        scanner, handlers = self.scanner
+        overlap = getattr(settings, 'STATICFILES_STREAM_OVERLAP', 8192)
+        buffered = ''
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is None:
+                limit = len(buffered)
+            else:
+                buffered += chunk
+                if len(buffered) < 2 * overlap:
+                    continue
+                limit = len(buffered) - overlap
+            position = 0
+            # a match starting before the limit ends within the buffer
+            for match in scanner.finditer(buffered):
+                if match.start() >= limit:
+                    break
+                if match.start() > position:
+                    yield None, buffered[position:match.start()]
+                prefix, handler = handlers[match.lastgroup]
+                yield handler, RuleMatch(match, prefix)
+                position = match.end()
+            if limit > position:
+                yield None, buffered[position:limit]
+                position = limit
+            buffered = buffered[position:]
 
+    def process_chunks(self, name, chunks):
+        """
+        Yields the processed content of ``name`` chunk by chunk, reading
+        its content from ``chunks`` as it goes.
+        """
+        if type(self).process.im_func is not BaseProcessor.process.im_func:
+            # a processor overriding process() needs all of the content
+            yield smart_str(self.process(name, ''.join(chunks)))
+            return
+        for handler, piece in self.scan_chunks(chunks):
+            if handler is None:
+                yield piece
+            else:
+                yield smart_str(getattr(self, handler)(name, piece))
+
+    def rebase(self, name, content, directory):
+        """
+        Returns ``content`` of ``name`` with its relative URLs made relative
+        to ``directory`` instead, e.g. for a bundle ``content`` is put in.
+        """
+        source = posixpath.dirname(name.replace(os.sep, '/'))
+        output = []
+        for handler, match in self.scan_chunks([content]):
+            if handler is None:
+                output.append(match)
+                continue
+            text, url = match.match.group(), match.group(self.url_group)
+            if url.startswith(('/', '#', 'http:', 'https:', 'data:')):
+                output.append(text)
+                continue
+            start, end = [index - match.start()
+                          for index in match.span(self.url_group)]
+            url = posixpath.relpath(posixpath.join(source, url), directory or '.')
+            output.append(text[:start] + url + text[end:])
+        return ''.join(output)
+
+    def find_urls(self, content):
+        """
+        Yields every URL ``content`` refers to, as it is written.
+        """
+        for handler, match in self.matches(content):
+            yield match.group(self.url_group)
+
+    def references(self, name, content):
+        """
+        Yields the names of the static files ``content`` of ``name`` refers to.
+        """
+        for url in self.find_urls(content):
+            if not url.startswith(('#', 'http:', 'https:', 'data:')):
+                yield self._resolve_url(name, posixpath.normpath(url))
+
+    def _resolve_url(self, name, url):
         name_parts = name.split(os.sep)
         if len(name_parts) == 1:
             name_parts = ['']
-        # Using posix normpath here to remove duplicates
-        url = posixpath.normpath(url)
         url_parts = url.split('/')
         parent_level, sub_level = url.count('..'), url.count('/')
         if url.startswith('/'):
@@ -50,102 +503,1518 @@ class BaseProcessor(object):
             else:
                 start, end = 1, sub_level - 1
         joined_result = '/'.join(name_parts[:-start] + url_parts[end:]).strip('/')
-        hashed_url = self.backend.url(unquote(joined_result), force=True)
+        return unquote(joined_result)
+
+    def _process_url(self, name, url):
+        # Completely ignore http(s) prefixed URLs,
+        # fragments and data-uri URLs
+        if url.startswith(('#', 'http:', 'https:', 'data:')):
+            return url
+
+        # the same URL from the same directory always resolves the same
+        # way within a post_process run
+        resolutions = getattr(self.backend, 'url_resolutions', None)
+        if resolutions is None:
+            return self._resolve_hashed_url(name, url)
+        key = (os.path.dirname(name), url, self.inline_urls)
+        try:
+            relative_url = resolutions[key]
+        except KeyError:
+            relative_url = resolutions[key] = self._resolve_hashed_url(name, url)
+            resolutions.misses += 1
+        else:
+            resolutions.hits += 1
+        return relative_url
+
+    def _resolve_hashed_url(self, name, url):
+        # Using posix normpath here to remove duplicates
+        url = posixpath.normpath(url)
+        resolved_name = self._resolve_url(name, url)
+        if self.inline_urls and hasattr(self.backend, 'data_uri'):
+            data_uri = self.backend.data_uri(resolved_name)
+            if data_uri is not None:
+                return data_uri
+        hashed_url = self.backend.url(resolved_name, force=True)
+        if self._is_alias(resolved_name, hashed_url):
+            return hashed_url
         file_name = hashed_url.split('/')[-1:]
         relative_url = '/'.join(url.split('/')[:-1] + file_name)
 
         # Return the hashed version to the file
         return unquote(relative_url)
 
+    def _is_alias(self, name, hashed_url):
+        # a duplicate aliased to a file of another directory can't be
+        # referred to relatively
+        if getattr(self.backend, 'deduplicate_mode', None) != 'alias':
+            return False
+        directory = posixpath.dirname(urlsplit(name).path)
+        expected = urlsplit(posixpath.join(self.backend.base_url, directory, '')).path
+        return posixpath.dirname(urlsplit(hashed_url).path) + '/' != expected
 
-class JsProcessor(BaseProcessor):
-    filepattern = '*.js'
-    pattern = re.compile(getattr(settings, 'STATIC_JSPROCESSOR_TEMPLATE',
-        r"""(?P<d1>['"])url\(\s*(?P<d>['\"])(?P<content>.*?)(?P=d)\s*\)(?p=d1)"""))
-        # it is needed for my project^
-        # r"STATIC.url\(\s*(?P<d>['\"])(?P<content>.*?)(?P=d)\s*\)"))
 
-    def __init__(self, backend):
-        self.backend = backend
+class JsProcessor(BaseProcessor):
+    filepatterns = ('*.js',)
+    url_group = 'content'
 
-    def process(self, name, content):
-        return self.pattern.sub(functools.partial(self._process, name), content)
+    def get_rules(self):
+        return (
+            (getattr(settings, 'STATIC_JSPROCESSOR_TEMPLATE',
+                r"""(?P<d1>['"])url\(\s*(?P<d>['"])(?P<content>[^'"\r\n]*)(?P=d)\s*\)(?P=d1)"""),
+                # it is needed for my project^
+                # r"STATIC.url\(\s*(?P<d>['\"])(?P<content>.*?)(?P=d)\s*\)"),
+             '_process'),
+        )
 
     def _process(self, name, match):
         url = match.group('content')
-        url = self._process_url(url)
+        url = self._process_url(name, url)
         return '"%s"' % url
 
 class CssProcessor(BaseProcessor):
-    filepattern = '*.css'
-    url_pattern = re.compile(r"""(url\(['"]{0,1}\s*(.*?)["']{0,1}\))""")
-    import_pattern = re.compile(r"""(@import\s*["']\s*(.*?)["'])""")
-
-    def process(self, name, content):
-        content = self.url_pattern.sub(functools.partial(self.do_process_url, name), content)
-        content = self.import_pattern.sub(functools.partial(self.do_process_import, name), content)
-        return content
+    filepatterns = ('*.css',)
+    inline_urls = True
+    # neither pattern can backtrack more than linearly: the URL parts
+    # can't match the quotes, spaces and parens around them
+    rules = (
+        (r"""url\(\s*(?:(?P<q>['"])\s*)?"""
+         r"""(?P<url>[^'"()\s]+(?:\s+[^'"()\s]+)*)\s*(?(q)(?P=q)\s*)\)""",
+         'do_process_url'),
+        (r"""@import\s*(?P<q>["'])\s*"""
+         r"""(?P<url>[^'"\s]+(?:\s+[^'"\s]+)*)\s*(?P=q)""",
+         'do_process_import'),
+    )
 
     def do_process_url(self, name, match):
-        url = self._process_url(name, match.group(2))
+        url = self._process_url(name, match.group('url'))
         return 'url("%s")' % url
 
-    def do_process_import(self, match, name):
-        url = self._process_url(name, match.group(2))
+    def do_process_import(self, name, match):
+        url = self._process_url(name, match.group('url'))
         return '@import "%s"' % url
 
 
-class HashedCache(dict):
-    
+class SourceMapProcessor(BaseProcessor):
+    """
+    Rewrites the ``sourceMappingURL`` comments of css and js files. Put it
+    after the processors of those files in STATICFILES_HASHED_PROCESSORS.
+    """
+    filepatterns = ('*.css', '*.js')
+    rules = (
+        (r"""(?P<comment>(?://|/\*)[#@]\s*sourceMappingURL=)(?P<url>[^\s*'"]+)""",
+         'do_process_source_map'),
+    )
+
+    def do_process_source_map(self, name, match):
+        url = self._process_url(name, match.group('url'))
+        return match.group('comment') + url
+
+
+class ProcessorChain(object):
+    """
+    Runs several processors, in order, over the files they all match.
+    """
+
+    def __init__(self, processors):
+        self.processors = processors
+
+    def process(self, name, content):
+        for processor in self.processors:
+            content = processor.process(name, content)
+        return content
+
+    def process_chunks(self, name, chunks):
+        for processor in self.processors:
+            chunks = processor.process_chunks(name, chunks)
+        return chunks
+
+    def rebase(self, name, content, directory):
+        for processor in self.processors:
+            content = processor.rebase(name, content, directory)
+        return content
+
+    def references(self, name, content):
+        for processor in self.processors:
+            for reference in processor.references(name, content):
+                yield reference
+
+
+class ProcessorIndex(object):
+    """
+    Finds the processors of a path by the suffixes of its file name, so
+    the usual ``*.ext`` patterns cost a dict lookup per dot in the name.
+    Other patterns are compiled once and matched one by one.
+    """
+    glob_chars_re = re.compile(r'[*?[/]')
+
+    def __init__(self, processors):
+        self.processors = processors
+        self.suffixes = {}
+        self.globs = []
+        self.chains = {}
+        for index, processor in enumerate(processors):
+            for pattern in processor.filepatterns:
+                suffix = pattern[1:]
+                if (pattern.startswith('*.') and
+                        not self.glob_chars_re.search(suffix)):
+                    self.suffixes.setdefault(suffix, []).append(index)
+                else:
+                    self.globs.append(
+                        (re.compile(fnmatch.translate(pattern)), index))
+
+    def lookup(self, path):
+        """
+        Returns the processor of ``path``, a ProcessorChain if several
+        processors match it, or None.
+        """
+        basename = os.path.basename(path)
+        indices = set()
+        position = basename.find('.')
+        while position != -1:
+            indices.update(self.suffixes.get(basename[position:], ()))
+            position = basename.find('.', position + 1)
+        for pattern, index in self.globs:
+            if pattern.match(path):
+                indices.add(index)
+        if not indices:
+            return None
+        if len(indices) == 1:
+            return self.processors[indices.pop()]
+        key = tuple(sorted(indices))
+        chain = self.chains.get(key)
+        if chain is None:
+            chain = self.chains[key] = ProcessorChain(
+                [self.processors[index] for index in key])
+        return chain
+
+
+class StageTimer(object):
+    """
+    Adds the time spent in a with block, and its ``size``, to a stage.
+    """
+
+    def __init__(self, stats, stage, size):
+        self.stats = stats
+        self.stage = stage
+        self.size = size
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add(self.stage, time.time() - self.started, self.size)
+
+
+class NullTimer(object):
+    size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Stats(object):
+    """
+    Calls, seconds and bytes of every stage of post_process and counters
+    of url(), collected from any thread. Seconds of stages which run in
+    the worker pool are summed over the workers.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+
+    def timer(self, stage, size=0):
+        return StageTimer(self, stage, size)
+
+    def add(self, stage, seconds, size=0):
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += size
+
+    def incr(self, counter, count=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + count
+
+    def report(self):
+        lines = ['%-32s %8s %10s %12s' % ('stage', 'calls', 'seconds', 'bytes')]
+        for stage, (calls, seconds, size) in sorted(
+                self.stages.items(), key=lambda item: -item[1][1]):
+            lines.append('%-32s %8d %10.3f %12d' % (stage, calls, seconds, size))
+        for counter, count in sorted(self.counters.items()):
+            lines.append('%-32s %8d' % (counter, count))
+        return '\n'.join(lines) + '\n'
+
+
+class NullStats(object):
+    """
+    Stats which collects nothing, the default.
+    """
+    enabled = False
+
+    def reset(self):
+        pass
+
+    def timer(self, stage, size=0):
+        return NULL_TIMER
+
+    def add(self, stage, seconds, size=0):
+        pass
+
+    def incr(self, counter, count=1):
+        pass
+
+    def report(self):
+        return ''
+
+
+class UploadQueue(object):
+    """
+    Saves files to ``storage`` from a pool of ``workers`` threads, with at
+    most ``workers * 2`` saves waiting, and retries a failed save up to
+    ``retries`` times after ``backoff``, ``2 * backoff``... seconds.
+    """
+
+    def __init__(self, storage, workers, retries=3, backoff=0.5):
+        self.storage = storage
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = ThreadPool(workers)
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.results = []
+        # the result of the last save of each name
+        self.saves = {}
+
+    def save(self, name, content):
+        self.slots.acquire()
+        try:
+            result = self.pool.apply_async(self._save, (name, content))
+        except:
+            self.slots.release()
+            raise
+        self.results.append(result)
+        self.saves[name] = result
+
+    def _save(self, name, content):
+        try:
+            for attempt in itertools.count():
+                try:
+                    return self.storage._save(name, content)
+                except Exception:
+                    if attempt >= self.retries:
+                        raise
+                    logger.warning("Saving %s failed, retrying", name,
+                                   exc_info=True)
+                    time.sleep(self.backoff * 2 ** attempt)
+        finally:
+            self.slots.release()
+
+    def wait(self):
+        """
+        Waits for the saves queued so far, and raises the error of a save
+        which failed every time. More saves can be queued afterwards.
+        """
+        results, self.results = self.results, []
+        for result in results:
+            result.get()
+
+    def wait_for(self, name):
+        """
+        Waits for the save of ``name``, if it was queued.
+        """
+        result = self.saves.get(name)
+        if result is not None:
+            result.get()
+
+    def join(self):
+        """
+        Waits for all the saves, and raises the error of a save which
+        failed every time.
+        """
+        self.pool.close()
+        try:
+            for result in self.results:
+                result.get()
+        finally:
+            self.terminate()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class UrlResolutions(dict):
+    """
+    Relative hashed URLs by (source directory, URL as written), for one
+    post_process run. The counters are updated without locking, so with
+    several workers they are approximate.
+    """
+
+    def __init__(self):
+        self.hits = self.misses = 0
+
+
+CACHE_KEY_PREFIX = u'staticfiles:'
+
+# the path of a hashed name, see HashedFilesStorage.hashed_name
+HASHED_PATH_RE = r'^(?P<root>.*)\.[0-9a-f]{%d}(?P<ext>(?:\.[^./]*)?)$'
+
+
+class ManifestIndex(object):
+    """
+    Read-only manifest stored as a sorted, fixed-layout binary index.
+
+    The file starts with a header, followed by one record per entry holding
+    the raw cache key digest and the offset and length of the value, sorted
+    by digest, and then the values themselves. It is opened with mmap and
+    searched in place, so nothing is parsed at startup and the pages are
+    shared between every process which maps the same file.
+    """
+    magic = 'SSMIDX01'
+    header = struct.Struct('<8sI')
+    record = struct.Struct('<16sII')
+
+    def __init__(self, fileobj):
+        self.map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = self.header.unpack_from(self.map, 0)
+        if magic != self.magic:
+            raise ValueError("%r is not a manifest index" % fileobj)
+        self.records_offset = self.header.size
+        self.values_offset = self.records_offset + self.count * self.record.size
+
+    @staticmethod
+    def key_digest(key):
+        if not key.startswith(CACHE_KEY_PREFIX):
+            return None
+        try:
+            digest = binascii.unhexlify(key[len(CACHE_KEY_PREFIX):])
+        except TypeError:
+            return None
+        if len(digest) != 16:
+            return None
+        return digest
+
+    @classmethod
+    def dump(cls, items, fileobj):
+        records = []
+        for key, value in items:
+            digest = cls.key_digest(key)
+            if digest is None:
+                raise ValueError("Can't store %r in a manifest index" % key)
+            records.append((digest, smart_str(value)))
+        records.sort()
+        fileobj.write(cls.header.pack(cls.magic, len(records)))
+        offset = 0
+        for digest, value in records:
+            fileobj.write(cls.record.pack(digest, offset, len(value)))
+            offset += len(value)
+        for digest, value in records:
+            fileobj.write(value)
+
+    def _value(self, position):
+        digest, offset, length = self.record.unpack_from(self.map,
+            self.records_offset + position * self.record.size)
+        offset += self.values_offset
+        return digest, self.map[offset:offset + length].decode('utf-8')
+
+    def get(self, key, default=None):
+        digest = self.key_digest(key)
+        if digest is None:
+            return default
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self.records_offset + mid * self.record.size
+            found = self.map[offset:offset + 16]
+            if found < digest:
+                lo = mid + 1
+            elif found > digest:
+                hi = mid
+            else:
+                return self._value(mid)[1]
+        return default
+
+    def iteritems(self):
+        for position in xrange(self.count):
+            digest, value = self._value(position)
+            yield CACHE_KEY_PREFIX + binascii.hexlify(digest), value
+
+    def __len__(self):
+        return self.count
+
+
+class BaseHashedCache(object):
+    """
+    Mapping of cache keys to hashed names, the manifest of the storage.
+
+    Subclasses keep the manifest in some store by implementing
+    read_generation(), read_many(), read_all(), write_many() and replace().
+    A post_process run clear()s the mapping, update()s it with every file
+    and stores all of them with set_many(), which replaces the manifest in
+    one go. Until then lookups of other processes keep hitting the previous
+    manifest. The generation, changed by every replace(), is looked up at
+    most every STATIC_CACHE_RELOAD_INTERVAL seconds (None to read it once).
+    """
+
     def __init__(self):
         self.filename = getattr(settings, 'STATIC_CACHE_FILE', 'static.json')
+        self.reload_interval = getattr(settings, 'STATIC_CACHE_RELOAD_INTERVAL', 1.0)
+        self.next_check = 0
+        self.generation = None
+        # bumped whenever entries may have changed rather than been added
+        self.version = 0
+        # entries which are not stored yet, and whether the stored ones
+        # were cleared
+        self.overlay = {}
+        self.cleared = False
+        self.lock = threading.RLock()
+
+    def refresh(self):
+        """
+        Picks up a manifest replaced by another process.
+        """
+        if self.version and (self.reload_interval is None or
+                             time.time() < self.next_check):
+            return False
+        self.next_check = time.time() + (self.reload_interval or 0)
+        generation = self.read_generation()
+        if self.version and generation == self.generation:
+            return False
+        with self.lock:
+            self.generation = generation
+            self.version += 1
+        return True
+
+    def get(self, key, default=None):
+        value = self.get_many([key]).get(key)
+        if value is None:
+            return default
+        return value
+
+    def get_many(self, keys):
+        """
+        Returns the values of the ``keys`` which are set, by key.
+        """
+        self.refresh()
+        values, missing = {}, []
+        for key in keys:
+            value = self.overlay.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                values[key] = value
+        if missing and not self.cleared:
+            values.update(self.read_many(missing))
+        return values
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def iteritems(self):
+        self.refresh()
+        if not self.cleared:
+            for key, value in self.read_all():
+                if key not in self.overlay:
+                    yield key, value
+        for item in self.overlay.items():
+            yield item
+
+    def items(self):
+        return list(self.iteritems())
+
+    def set(self, key, value):
+        with self.lock:
+            if self.cleared:
+                self.overlay[key] = value
+            else:
+                self.write_many({key: value})
+
+    def set_many(self, values):
+        with self.lock:
+            self.overlay.update(values)
+            self.replace(dict(self.iteritems()))
+            self.overlay = {}
+            self.cleared = False
+            self.next_check = 0
+            self.refresh()
+
+    def update(self, values):
+        """
+        Sets ``values`` in memory only, until the next set_many().
+        """
+        with self.lock:
+            self.overlay.update(values)
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.overlay = {}
+            self.cleared = True
+
+    def read_generation(self):
+        raise NotImplementedError
+
+    def read_many(self, keys):
+        raise NotImplementedError
+
+    def read_all(self):
+        raise NotImplementedError
+
+    def write_many(self, values):
+        raise NotImplementedError
+
+    def replace(self, values):
+        raise NotImplementedError
+
+
+class MemoryHashedCache(BaseHashedCache):
+    """
+    Manifest which is only kept in memory, e.g. the partial manifest of a
+    shard of post_process.
+    """
+
+    def __init__(self):
+        super(MemoryHashedCache, self).__init__()
+        self.values = {}
+
+    def read_generation(self):
+        return None
+
+    def read_many(self, keys):
+        return dict((key, self.values[key]) for key in keys if key in self.values)
+
+    def read_all(self):
+        return self.values.items()
+
+    def write_many(self, values):
+        self.values.update(values)
+
+    def replace(self, values):
+        self.values = dict(values)
+
+
+class HashedCache(BaseHashedCache):
+    """
+    Mapping of cache keys to hashed names, persisted in STATIC_CACHE_FILE.
+
+    The manifest is either JSON or a ManifestIndex, as selected for writing
+    by STATIC_CACHE_FORMAT ('json' or 'binary') and detected on reading.
+    Misses are staged in memory and appended to a journal next to the
+    manifest in batches of STATIC_CACHE_FLUSH_SIZE entries. Once the journal
+    grows past STATIC_CACHE_COMPACT_SIZE entries it is compacted back into
+    the manifest, which is always replaced atomically.
+
+    Journal appends and compactions of all processes sharing the manifest
+    are serialized by a lock file next to it. Every STATIC_CACHE_RELOAD_INTERVAL
+    seconds (None to disable) a lookup compares the inode, mtime and size
+    of the manifest with the ones it was read with, and swaps in the new
+    manifest if another process, e.g. a collectstatic run, replaced it.
+    """
+
+    def __init__(self):
+        super(HashedCache, self).__init__()
+        self.format = getattr(settings, 'STATIC_CACHE_FORMAT', 'json')
+        self.journal_filename = self.filename + '.journal'
+        self.flush_size = getattr(settings, 'STATIC_CACHE_FLUSH_SIZE', 64)
+        self.compact_size = getattr(settings, 'STATIC_CACHE_COMPACT_SIZE', 4096)
+        self.lock_filename = self.filename + '.lock'
+        # inode, mtime and size of the manifest the data was read from
+        self.stamp = None
+        # set while there are entries in memory which are not in any file
+        self.dirty = False
+        # entries read from the manifest, set on top of them and staged
+        # for the journal
+        self.data = {}
+        self.pending = {}
+        self.journal_size = 0
+        self.load()
+        atexit.register(self._flush_at_exit)
+
+    def load(self):
+        stamp = self.manifest_stamp()
+        data = self.read_manifest()
+        overlay, journal_size = self.read_journal()
+        with self.lock:
+            self.version += 1
+            self.data, self.stamp = data, stamp
+            self.overlay = overlay
+            self.journal_size = journal_size
+            self.next_check = time.time() + (self.reload_interval or 0)
+
+    def manifest_stamp(self):
         try:
-            self.update(json.load(open(self.filename, 'r')))
-        except (IOError, ValueError):
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime, st.st_size
+
+    def refresh(self):
+        """
+        Reloads the manifest if it was replaced since it was read, at most
+        once every STATIC_CACHE_RELOAD_INTERVAL seconds.
+        """
+        if self.reload_interval is None or time.time() < self.next_check:
+            return False
+        self.next_check = time.time() + self.reload_interval
+        if self.dirty or self.manifest_stamp() == self.stamp:
+            return False
+        self.pending.clear()
+        self.load()
+        return True
+
+    def read_journal(self):
+        entries, size = {}, 0
+        try:
+            with open(self.journal_filename, 'r') as jf:
+                for line in jf:
+                    try:
+                        batch = json.loads(line)
+                    except ValueError:
+                        # torn append from a crashed process, those
+                        # entries will simply be missed again
+                        continue
+                    entries.update(batch)
+                    size += len(batch)
+        except IOError:
             pass
+        return entries, size
+
+    def read_manifest(self):
+        try:
+            sf = open(self.filename, 'rb')
+        except IOError:
+            return {}
+        with sf:
+            if sf.read(len(ManifestIndex.magic)) == ManifestIndex.magic:
+                return ManifestIndex(sf)
+            sf.seek(0)
+            try:
+                return json.load(sf)
+            except ValueError:
+                return {}
+
+    def write_manifest(self, sf):
+        if self.format == 'binary':
+            ManifestIndex.dump(self.iteritems(), sf)
+        else:
+            # sorted, so equal manifests are equal files
+            json.dump(dict(self.iteritems()), sf, sort_keys=True)
+
+    def get(self, key, default=None):
+        self.refresh()
+        value = self.overlay.get(key)
+        if value is None:
+            value = self.data.get(key, default)
+        return value
+
+    def get_many(self, keys):
+        """
+        Returns the values of the ``keys`` which are set, by key.
+        """
+        self.refresh()
+        values = {}
+        overlay, data = self.overlay, self.data
+        for key in keys:
+            value = overlay.get(key)
+            if value is None:
+                value = data.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def iteritems(self):
+        for key, value in self.data.iteritems():
+            if key not in self.overlay:
+                yield key, value
+        for item in self.overlay.iteritems():
+            yield item
 
     def set(self, key, value):
-        self[key] = value
-        self.save()
+        with self.lock:
+            self.overlay[key] = value
+            if self.dirty:
+                # goes to the manifest with the rest on the next save()
+                return
+            self.pending[key] = value
+            if len(self.pending) >= self.flush_size:
+                self.flush()
 
     def set_many(self, values):
-        self.update(values)
-        self.save()
+        with self.lock:
+            self.overlay.update(values)
+            self.version += 1
+            self.save()
+
+    def update(self, values):
+        """
+        Sets ``values`` in memory only, until the next save().
+        """
+        with self.lock:
+            self.overlay.update(values)
+            self.dirty = True
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.dirty = True
+            self.data = {}
+            self.overlay.clear()
+            self.pending.clear()
+
+    def flush(self):
+        """
+        Appends staged misses to the journal, compacting it if needed.
+        Nothing is written while there are unsaved entries in memory, e.g.
+        while post_process builds a new manifest.
+        """
+        with self.lock:
+            if self.dirty or not self.pending:
+                return
+            with file_lock(self.lock_filename):
+                if self.manifest_stamp() != self.stamp:
+                    # the misses were resolved against a manifest which
+                    # has been replaced since, they can't go into its journal
+                    self.pending.clear()
+                    return self.load()
+                if self.journal_size + len(self.pending) > self.compact_size:
+                    # keep what other processes journaled since we read it
+                    entries, size = self.read_journal()
+                    entries.update(self.overlay)
+                    self.overlay = entries
+                    return self._save()
+                with open(self.journal_filename, 'a') as jf:
+                    jf.write(json.dumps(self.pending) + '\n')
+                self.journal_size += len(self.pending)
+                self.pending.clear()
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception:
+            # staged entries are only a cache, losing them on a broken
+            # shutdown costs a few misses in the next process
+            pass
 
     def save(self):
-        with open(self.filename, 'w') as sf:
-            json.dump(self, sf)
-        
-        
+        """
+        Writes the whole mapping to the manifest and drops the journal.
+        """
+        with self.lock:
+            with file_lock(self.lock_filename):
+                self._save()
+
+    def _save(self):
+        atomic_write(self.filename, self.write_manifest)
+        try:
+            os.unlink(self.journal_filename)
+        except OSError:
+            pass
+        if self.format == 'binary':
+            # mapped again, to share its pages instead of a copy in memory
+            self.data = self.read_manifest()
+        else:
+            self.data = dict(self.iteritems())
+        self.stamp = self.manifest_stamp()
+        self.overlay = {}
+        self.pending.clear()
+        self.journal_size = 0
+        self.dirty = False
+
+    def export_json(self, filename):
+        with open(filename, 'w') as jf:
+            json.dump(dict(self.iteritems()), jf, sort_keys=True)
+
+    def import_json(self, filename):
+        with open(filename, 'r') as jf:
+            values = json.load(jf)
+        with self.lock:
+            self.clear()
+            self.set_many(values)
+
+
+class DjangoCacheHashedCache(BaseHashedCache):
+    """
+    Keeps the manifest in the STATIC_CACHE_ALIAS cache of Django's cache
+    framework, so processes without a shared filesystem can share it.
+
+    Every manifest is stored under keys of its own generation, with the
+    list of its keys in chunks of ``keys_chunk_size`` (cache items are
+    limited in size, 1MB for memcached), before the generation key is
+    switched over to it. Entries are stored with STATIC_CACHE_TIMEOUT, or
+    as good as without expiry if it is None; expired ones are simply
+    hashed again.
+    """
+    keys_chunk_size = 5000
+    # the timeout used if STATIC_CACHE_TIMEOUT is None, as Django's caches
+    # take a timeout of None for their default one and can't store
+    # without expiry
+    max_timeout = 10 * 365 * 24 * 60 * 60
+
+    def __init__(self):
+        super(DjangoCacheHashedCache, self).__init__()
+        self.cache = get_cache(getattr(settings, 'STATIC_CACHE_ALIAS', 'default'))
+        self.timeout = (getattr(settings, 'STATIC_CACHE_TIMEOUT', None) or
+                        self.max_timeout)
+        self.generation_key = CACHE_KEY_PREFIX + 'generation'
+
+    def make_key(self, key, generation=None):
+        return '%s:%s' % (generation or self.generation, key)
+
+    def read_generation(self):
+        return self.cache.get(self.generation_key)
+
+    def read_many(self, keys):
+        if self.generation is None:
+            return {}
+        values = self.cache.get_many([self.make_key(key) for key in keys])
+        prefix_length = len(self.make_key(''))
+        return dict((key[prefix_length:], value)
+                    for key, value in values.iteritems())
+
+    def read_all(self):
+        if self.generation is None:
+            return []
+        chunks = self.cache.get(self.make_key('keys')) or 0
+        keys = self.cache.get_many([self.make_key('keys:%d' % chunk)
+                                    for chunk in range(chunks)])
+        return self.read_many(itertools.chain(*keys.values())).iteritems()
+
+    def write_many(self, values):
+        if self.generation is None:
+            generation = uuid.uuid4().hex
+            self.cache.add(self.generation_key, generation, self.timeout)
+            self.generation = self.read_generation() or generation
+        self.cache.set_many(dict((self.make_key(key), value)
+                                 for key, value in values.iteritems()),
+                            self.timeout)
+
+    def replace(self, values):
+        generation = uuid.uuid4().hex
+        self.cache.set_many(dict((self.make_key(key, generation), value)
+                                 for key, value in values.iteritems()),
+                            self.timeout)
+        keys, size = values.keys(), self.keys_chunk_size
+        chunks = dict((self.make_key('keys:%d' % (start // size), generation),
+                       keys[start:start + size])
+                      for start in range(0, len(keys), size))
+        chunks[self.make_key('keys', generation)] = len(chunks)
+        self.cache.set_many(chunks, self.timeout)
+        self.cache.set(self.generation_key, generation, self.timeout)
+
+
+class SqliteHashedCache(BaseHashedCache):
+    """
+    Keeps the manifest in an SQLite database at STATIC_CACHE_FILE, which
+    processes on one host can share without loading it into memory.
+    """
+
+    # SQLITE_MAX_VARIABLE_NUMBER is 999 by default
+    chunk_size = 500
+
+    def __init__(self):
+        if sqlite3 is None:
+            raise ImproperlyConfigured("SqliteHashedCache requires the "
+                                       "sqlite3 module.")
+        super(SqliteHashedCache, self).__init__()
+        self.generation_key = CACHE_KEY_PREFIX + 'generation'
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        # sqlite3 connections can't be shared between threads, nor with
+        # the processes forked after warm() opened one
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.filename, timeout=30)
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS manifest '
+                    '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def read_generation(self):
+        return self.read_many([self.generation_key]).get(self.generation_key)
+
+    def read_many(self, keys):
+        values = {}
+        for start in xrange(0, len(keys), self.chunk_size):
+            chunk = keys[start:start + self.chunk_size]
+            values.update(self.connection.execute(
+                'SELECT key, value FROM manifest WHERE key IN (%s)'
+                % ', '.join('?' * len(chunk)), chunk))
+        return values
+
+    def read_all(self):
+        return self.connection.execute(
+            'SELECT key, value FROM manifest WHERE key != ?',
+            (self.generation_key,))
+
+    def write_many(self, values):
+        with self.connection as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO manifest (key, value) VALUES (?, ?)',
+                values.iteritems())
+
+    def replace(self, values):
+        values = dict(values)
+        values[self.generation_key] = uuid.uuid4().hex
+        with self.connection as connection:
+            connection.execute('DELETE FROM manifest')
+            connection.executemany(
+                'INSERT INTO manifest (key, value) VALUES (?, ?)',
+                values.iteritems())
+
+
+class FingerprintIndex(dict):
+    """
+    Size, mtime, content digest and hashed references of every file the
+    last incremental post_process run saw, by name. The index is empty if
+    it was saved with another ``signature`` of the settings which shape
+    the hashed files.
+    """
+
+    def __init__(self, filename, signature):
+        self.filename = filename
+        self.signature = signature
+        try:
+            with open(self.filename, 'r') as ff:
+                index = json.load(ff)
+        except (IOError, ValueError):
+            return
+        if isinstance(index, dict) and index.get('signature') == signature:
+            self.update(index['files'])
+
+    def save(self):
+        atomic_write(self.filename, lambda ff: json.dump(
+            {'signature': self.signature, 'files': self}, ff))
+
+
+class GenerationHistory(list):
+    """
+    The time and the names of the files of the last post_process runs,
+    oldest first.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(self.filename, 'r') as ff:
+                self.extend(json.load(ff))
+        except (IOError, ValueError):
+            pass
+
+    def save(self):
+        atomic_write(self.filename, lambda ff: json.dump(self, ff))
+
 
-    
 class HashedFilesStorage(StaticFilesStorage):
 
     def __init__(self, *args, **kwargs):
-        self.cache = HashedCache()
+        # the manifest is created and loaded on first use, see warm()
+        self._cache = None
+        self._cache_lock = threading.Lock()
+        self.fingerprints = None
+        self.url_resolutions = None
+        self.url_resolution_stats = None
+        self.url_table_enabled = getattr(settings, 'STATICFILES_URL_TABLE', False)
+        self._url_table = None
+        self._url_table_version = None
+        self._processors = None
+        self._processor_index = None
+        self._compress_re = None
+        self.stats = self._make_stats()
+        self.hash_algorithm = getattr(settings, 'STATICFILES_HASH_ALGORITHM', 'md5')
+        self.hash_length = getattr(settings, 'STATICFILES_HASH_LENGTH', 12)
+        self.integrity_algorithm = getattr(settings,
+            'STATICFILES_INTEGRITY_ALGORITHM', None)
+        self.hashed_path_re = re.compile(HASHED_PATH_RE % self.hash_length)
+        # (index, count) of the shard post_process works on, see
+        # merge_shards()
+        self.shard = getattr(settings, 'STATICFILES_SHARD', None)
+        # digests of local files by path, size and mtime, and the integrity
+        # values post_process collects by name
+        self.digests = {}
+        self._integrities = None
+        # data URIs by digest and type while post_process inlines files,
+        # and the contents of the small files it saved by digest
+        self._data_uris = None
+        self._inline_contents = None
+        # final contents of the files of bundles by name, while
+        # post_process builds bundles
+        self._bundled = None
+        # hashed names by content digest while post_process deduplicates
+        self.deduplicate_mode = None
+        self._contents = None
+        self._contents_lock = threading.Lock()
+        # names in the storage while post_process has them listed, and the
+        # queue of its uploads
+        self._existing = None
+        self._uploads = None
+        self._local = threading.local()
         super(HashedFilesStorage, self).__init__(*args, **kwargs)
 
-    def hashed_name(self, name, content=None):
-        parsed_name = urlsplit(unquote(name))
-        clean_name = parsed_name.path.strip()
+    @property
+    def cache(self):
+        if self._cache is None:
+            with self._cache_lock:
+                if self._cache is None:
+                    self._cache = get_storage_class(getattr(settings,
+                        'STATIC_CACHE_BACKEND', 'django_staticstorages.HashedCache'))()
+        return self._cache
+
+    def warm(self):
+        """
+        Loads the manifest, compiles the processors' patterns and builds the
+        url table if it is enabled, all of which otherwise happen on first
+        use. Call it in the master process of a preforking server so the
+        workers share the result instead of each paying for it.
+        """
+        self.cache.refresh()
+        for processor in self.processors:
+            processor.scanner
+        if self.url_table_enabled:
+            self.url_table
+
+    def _make_stats(self):
+        collector = getattr(settings, 'STATICFILES_STATS', False)
+        if not collector:
+            return NullStats()
+        if collector is True:
+            return Stats()
+        return get_storage_class(collector)()
+
+    @property
+    def processors(self):
+        if self._processors is None:
+            processors = getattr(settings, 'STATICFILES_HASHED_PROCESSORS', 
+                DEFAULT_HASHED_PROCESSORS)
+            self._processors = [get_storage_class(p)(self) for p in processors]
+        return self._processors
+
+    def processor_for(self, path):
+        if self._processor_index is None:
+            self._processor_index = ProcessorIndex(self.processors)
+        return self._processor_index.lookup(path)
+
+    def new_hash(self):
+        algorithms = [self.hash_algorithm]
+        if self.integrity_algorithm:
+            algorithms.append(self.integrity_algorithm)
+        return MultiHash(algorithms)
+
+    def file_hash(self, content):
+        """
+        Returns the hex digest of ``content``.
+        """
+        return self.file_digests(content)[0]
+
+    def file_digests(self, content):
+        """
+        Returns the hex digest and the integrity value of ``content``, from
+        the digest cache if it is a local file hashed before.
+        """
+        key = self._digest_key(content)
+        digests = self.digests.get(key) if key is not None else None
+        if digests is None:
+            hasher = self.new_hash()
+            with self.stats.timer('hash') as timer:
+                for chunk in content.chunks():
+                    hasher.update(chunk)
+                    timer.size += len(chunk)
+            digests = self._cache_digests(key, hasher)
+        return digests
+
+    def _digest_key(self, content):
+        try:
+            st = os.fstat(content.fileno())
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+        # mtimes may only have a resolution of seconds, so a file modified
+        # within the last ones can change again without its mtime changing
+        if time.time() - st.st_mtime < 2:
+            return None
+        return content.name, st.st_size, st.st_mtime
+
+    def _cache_digests(self, key, hasher):
+        digests = hasher.hexdigest(), hasher.integrity()
+        if key is not None:
+            self.digests[key] = digests
+        return digests
+
+    def integrity_key(self, name):
+        return self.cache_key(name + '\0integrity')
+
+    def integrity(self, name):
+        """
+        Returns the Subresource Integrity value of the hashed file of
+        ``name``, e.g. ``'sha384-...'``, if STATICFILES_INTEGRITY_ALGORITHM
+        is set.
+        """
+        if not self.integrity_algorithm:
+            return None
+        value = self.cache.get(self.integrity_key(name))
+        if value is None:
+            hashed_name = (self.cache.get(self.cache_key(name)) or
+                           self.hashed_name(name))
+            with self.open(urlsplit(hashed_name).path) as hashed_file:
+                value = self.file_digests(hashed_file)[1]
+            self.cache.set(self.integrity_key(name), value)
+        return value
+
+    def _add_integrity(self, name, integrity):
+        if self._integrities is not None and integrity is not None:
+            self._integrities[name] = integrity
+
+    def data_uri(self, name):
+        """
+        Returns the hashed file of ``name`` as a base64 data URI if it is
+        at most STATICFILES_INLINE_MAX_SIZE bytes and its type is one of
+        STATICFILES_INLINE_TYPES, None otherwise. Inlining is disabled
+        unless the size is set.
+        """
+        max_size = getattr(settings, 'STATICFILES_INLINE_MAX_SIZE', 0)
+        if not max_size or '?' in name or '#' in name:
+            return None
+        mimetype = mimetypes.guess_type(name)[0]
+        if mimetype not in getattr(settings, 'STATICFILES_INLINE_TYPES',
+                                   DEFAULT_INLINE_TYPES):
+            return None
+        hashed_name = self.cache.get(self.cache_key(name)) or self.hashed_name(name)
+        # hashed names end with the digest of the content, so files with
+        # the same content and type are encoded once per post_process
+        digest = self._name_digest(hashed_name)
+        key = (digest, mimetype)
+        data_uris = self._data_uris
+        if data_uris is not None and key in data_uris:
+            return data_uris[key]
+        # files saved by this post_process may still be queued for upload
+        content = (self._inline_contents or {}).get(digest)
         if content is None:
-            if not self.exists(clean_name):
-                raise ValueError("The file '%s' could not be found with %r." %
-                                 (clean_name, self))
+            with self.open(hashed_name) as hashed_file:
+                content = hashed_file.read(max_size + 1)
+        data_uri = None
+        if len(content) <= max_size:
+            data_uri = 'data:%s;base64,%s' % (mimetype, base64.b64encode(content))
+            self.stats.incr('inline.files')
+        if data_uris is not None:
+            data_uris[key] = data_uri
+        return data_uri
+
+    def _name_digest(self, hashed_name):
+        return posixpath.splitext(hashed_name)[0][-self.hash_length:]
+
+    def _save_hashed(self, name, content, hashed_name=None, aliasable=True):
+        """
+        Saves ``content`` of ``name`` under its hashed name unless a file of
+        that name exists, reading ``content`` only once. Small files are kept
+        in memory until the hash is known, larger ones are hashed while they
+        are written to a temporary file which is then renamed (or uploaded,
+        for storages without local paths). A given ``hashed_name`` is used
+        instead, and overwritten.
+
+        Returns the digest, the hashed name and whether a file was saved.
+        """
+        hasher = self.new_hash()
+        chunks = content.chunks()
+        buffered, size = [], 0
+        buffer_size = getattr(settings, 'STATICFILES_COPY_BUFFER_SIZE', 1024 * 1024)
+        for chunk in chunks:
+            hasher.update(chunk)
+            buffered.append(chunk)
+            size += len(chunk)
+            if size > buffer_size:
+                break
+        else:
+            digest, hashed_name, exists = self._hashed_target(
+                name, content, hasher, hashed_name)
+            if (self._inline_contents is not None and
+                    size <= getattr(settings, 'STATICFILES_INLINE_MAX_SIZE', 0)):
+                self._inline_contents[self._name_digest(hashed_name)] = \
+                    ''.join(buffered)
+            if exists:
+                self._add_content(digest, hashed_name)
+                return digest, hashed_name, False
+            duplicate = self._save_duplicate(name, hashed_name, digest, aliasable)
+            if duplicate is not None:
+                return digest, duplicate, True
+            saved_name = self._upload(hashed_name, ContentFile(''.join(buffered)))
+            hashed_name = force_unicode(saved_name.replace('\\', '/'))
+            self._add_content(digest, hashed_name)
+            return digest, hashed_name, True
+
+        try:
+            full_path = self.path(name)
+        except NotImplementedError:
+            full_path = None
+            tmp_file = tempfile.SpooledTemporaryFile(max_size=buffer_size)
+        else:
+            directory = os.path.dirname(full_path)
             try:
-                content = self.open(clean_name)
-            except IOError:
-                # Handle directory paths and fragments
-                return name
-        path, filename = os.path.split(clean_name)
-        root, ext = os.path.splitext(filename)
-        # Get the MD5 hash of the file
-        md5 = hashlib.md5()
-        for chunk in content.chunks():
-            md5.update(chunk)
-        md5sum = md5.hexdigest()[:12]
-        hashed_name = os.path.join(path, u"%s.%s%s" %
-                                   (root, md5sum, ext))
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            tmp_path = os.path.join(directory, '.%s.%s' % (
+                os.path.basename(full_path), uuid.uuid4().hex))
+            # created like FileSystemStorage does, to get the same mode
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                         getattr(os, 'O_BINARY', 0), 0666)
+            tmp_file = os.fdopen(fd, 'wb')
+
+        try:
+            with tmp_file:
+                for chunk in buffered:
+                    tmp_file.write(chunk)
+                del buffered[:]
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    tmp_file.write(chunk)
+                    size += len(chunk)
+                digest, hashed_name, exists = self._hashed_target(
+                    name, content, hasher, hashed_name)
+                if exists:
+                    self._add_content(digest, hashed_name)
+                    return digest, hashed_name, False
+                duplicate = self._save_duplicate(name, hashed_name, digest,
+                                                 aliasable)
+                if duplicate is not None:
+                    return digest, duplicate, True
+                if full_path is None:
+                    tmp_file.seek(0)
+                    tmp_content = File(tmp_file)
+                    tmp_content.size = size
+                    saved_name = self._save(hashed_name, tmp_content)
+                    hashed_name = force_unicode(saved_name.replace('\\', '/'))
+                    self._mark_existing(hashed_name)
+            if full_path is not None:
+                if settings.FILE_UPLOAD_PERMISSIONS is not None:
+                    os.chmod(tmp_path, settings.FILE_UPLOAD_PERMISSIONS)
+                os.rename(tmp_path, self.path(hashed_name))
+                self._mark_existing(hashed_name)
+                tmp_path = None
+        finally:
+            if full_path is not None and tmp_path is not None:
+                os.unlink(tmp_path)
+        self._add_content(digest, hashed_name)
+        return digest, hashed_name, True
+
+    def _hashed_target(self, name, content, hasher, hashed_name):
+        """
+        Returns the digest of ``content`` ``hasher`` has read, the hashed
+        name to save it as and whether a file of that name exists. An
+        existing file of a given ``hashed_name`` is deleted.
+        """
+        digest, integrity = self._cache_digests(self._digest_key(content), hasher)
+        self._add_integrity(name, integrity)
+        if hashed_name is None:
+            hashed_name = self.hashed_name(name, file_hash=digest)
+            with self.stats.timer('storage.exists'):
+                return digest, hashed_name, self.exists(hashed_name)
+        with self.stats.timer('storage.exists'):
+            exists = self.exists(hashed_name)
+        if exists:
+            with self.stats.timer('storage.delete'):
+                self.delete(hashed_name)
+        return digest, hashed_name, False
+
+    def exists(self, name):
+        existing = self._existing
+        if existing is not None:
+            return name.replace('\\', '/') in existing
+        return super(HashedFilesStorage, self).exists(name)
+
+    def delete(self, name):
+        super(HashedFilesStorage, self).delete(name)
+        if self._existing is not None:
+            self._existing.discard(name.replace('\\', '/'))
+
+    def _mark_existing(self, name):
+        if self._existing is not None:
+            self._existing.add(name.replace('\\', '/'))
+
+    def _list_all(self, path=''):
+        """
+        Returns the names of all files in the storage below ``path``.
+        """
+        return set(self._walk(path))
+
+    def _walk(self, path=''):
+        """
+        Yields the names of all files in the storage below ``path``,
+        listing one directory at a time.
+        """
+        try:
+            directories, files = self.listdir(path)
+        except (OSError, IOError):
+            return
+        for filename in files:
+            yield posixpath.join(path, filename)
+        for directory in directories:
+            for name in self._walk(posixpath.join(path, directory)):
+                yield name
+
+    def _is_hashed_name(self, name):
+        root, ext = posixpath.splitext(name)
+        if ext[1:] in COMPRESSORS:
+            name = root
+        return self.hashed_path_re.match(name) is not None
+
+    def prune(self, keep=None, min_age=0, batch_size=1000, dry_run=False):
+        """
+        Deletes the hashed files and compressed variants which neither the
+        manifest nor the last ``keep`` generations recorded with
+        STATICFILES_GENERATIONS (all of them by default) refer to and which
+        were modified at least ``min_age`` seconds ago, ``batch_size`` at a
+        time. Yields the names of the deleted files.
+
+        post_process waits for it to finish, and the other way round.
+        """
+        with file_lock(self.history_filename + '.lock'):
+            history = GenerationHistory(self.history_filename)
+            if not history:
+                raise ValueError("No generations are recorded in '%s', set "
+                                 "STATICFILES_GENERATIONS and run collectstatic."
+                                 % self.history_filename)
+            referenced = set(hashed_name for key, hashed_name
+                             in self.cache.iteritems())
+            for generation in history[-keep if keep else 0:]:
+                referenced.update(generation['names'])
+            stale = []
+            for name in itertools.chain(self._walk(), [None]):
+                if name is not None:
+                    if name in referenced or not self._is_hashed_name(name):
+                        continue
+                    if min_age and time.time() - time.mktime(
+                            self.modified_time(name).timetuple()) < min_age:
+                        continue
+                    stale.append(name)
+                    if len(stale) < batch_size:
+                        continue
+                for stale_name in stale:
+                    if not dry_run:
+                        self.delete(stale_name)
+                    yield stale_name
+                if stale:
+                    logger.info("%s %d stale files", 'Found' if dry_run
+                                else 'Deleted', len(stale))
+                stale = []
+
+    def _upload(self, name, content):
+        """
+        Saves ``content`` as ``name`` right away, or hands it to the upload
+        queue post_process runs with STATICFILES_UPLOAD_WORKERS. Returns the
+        saved name.
+        """
+        self._mark_existing(name)
+        with self.stats.timer('storage.save', content.size):
+            if self._uploads is None:
+                return self._save(name, content)
+            self._uploads.save(name, content)
+        return name
+
+    def _add_content(self, digest, hashed_name):
+        # aliases go to the targets post_process picked up front
+        if self._contents is not None and self.deduplicate_mode != 'alias':
+            with self._contents_lock:
+                self._contents.setdefault(digest, hashed_name)
+
+    def _save_duplicate(self, name, hashed_name, digest, aliasable=True):
+        """
+        Stores ``hashed_name`` as a duplicate of a file post_process saved
+        before with the same ``digest``, as a hard link or a symbolic link,
+        or as an alias, i.e. by mapping ``name`` to the hashed name picked
+        for the files of that content.
+
+        Returns the hashed name to record for ``name``, or None if there is
+        no such file and ``hashed_name`` is to be saved.
+        """
+        if self._contents is None:
+            return None
+        original = self._contents.get(digest)
+        if original is None or original == hashed_name:
+            return None
+        mode = self.deduplicate_mode
+        if mode == 'alias':
+            if not aliasable:
+                return None
+            self.stats.incr('deduplicate.aliases')
+            return original
+        if self._uploads is not None:
+            # the file to link to may still be queued for upload
+            self._uploads.wait_for(original)
+        target, link = self.path(original), self.path(hashed_name)
+        try:
+            os.makedirs(os.path.dirname(link))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        if mode == 'symlink':
+            os.symlink(os.path.relpath(target, os.path.dirname(link)), link)
+        else:
+            os.link(target, link)
+        self._mark_existing(hashed_name)
+        self.stats.incr('deduplicate.%ss' % mode)
+        return hashed_name
+
+    def _deduplicate_mode(self):
+        mode = getattr(settings, 'STATICFILES_DEDUPLICATE', False)
+        if mode is not True:
+            return mode or None
+        try:
+            self.path('')
+        except NotImplementedError:
+            return 'alias'
+        return 'hardlink' if hasattr(os, 'link') else 'alias'
+
+    def hashed_name(self, name, content=None, file_hash=None):
+        parsed_name = urlsplit(unquote(name))
+        clean_name = parsed_name.path.strip()
+        hashed_name = None
+        if content is None and file_hash is None:
+            if clean_name != name:
+                # the file itself may be known already, e.g. a reference
+                # with a fragment to a file post_process has just saved
+                hashed_name = self.cache.get(self.cache_key(clean_name))
+            if hashed_name is None:
+                if not self.exists(clean_name):
+                    raise ValueError("The file '%s' could not be found with %r." %
+                                     (clean_name, self))
+                try:
+                    content = self.open(clean_name)
+                except IOError:
+                    # Handle directory paths and fragments
+                    return name
+                content = self._processed_content(clean_name, content)
+        if hashed_name is None:
+            path, filename = os.path.split(clean_name)
+            root, ext = os.path.splitext(filename)
+            # Get the MD5 hash of the file
+            if file_hash is None:
+                file_hash = self.file_hash(content)
+            hashed_name = os.path.join(path, u"%s.%s%s" %
+                (root, file_hash[:self.hash_length], ext))
         unparsed_name = list(parsed_name)
         unparsed_name[2] = hashed_name
         # Special casing for a @font-face hack, like url(myfont.eot?#iefix")
@@ -154,28 +2023,202 @@ class HashedFilesStorage(StaticFilesStorage):
             unparsed_name[2] += '?'
         return urlunsplit(unparsed_name)
     
+    def _processed_content(self, name, content):
+        """
+        Returns ``content`` of ``name`` as post_process saves it, so that a
+        miss hashes the same bytes post_process did.
+        """
+        processor = self.processor_for(name)
+        in_progress = getattr(self._local, 'in_progress', None)
+        if in_progress is None:
+            in_progress = self._local.in_progress = set()
+        # a file within a reference cycle is hashed from its original
+        # content, see post_process
+        if processor is None or name in in_progress:
+            return content
+        in_progress.add(name)
+        try:
+            with content:
+                processed = self.run_processor(processor, name, content.read())
+        finally:
+            in_progress.discard(name)
+        return ContentFile(smart_str(processed))
+
+    def run_processor(self, processor, name, content):
+        """
+        Returns ``content`` of ``name`` processed by ``processor``, timing
+        every processor of a chain on its own.
+        """
+        for processor in getattr(processor, 'processors', (processor,)):
+            with self.stats.timer('process.%s' % type(processor).__name__,
+                                  len(content)):
+                content = processor.process(name, content)
+        return content
+
+    def process_chunks(self, processor, name, chunks):
+        """
+        Returns the chunks of the content ``chunks`` of ``name`` processed
+        by ``processor``, timing every processor of a chain on its own.
+        """
+        for processor in getattr(processor, 'processors', (processor,)):
+            if self.stats.enabled:
+                chunks = self._timed_chunks(
+                    'process.%s' % type(processor).__name__,
+                    functools.partial(processor.process_chunks, name), chunks)
+            else:
+                chunks = processor.process_chunks(name, chunks)
+        return chunks
+
+    def _timed_chunks(self, stage, process, chunks):
+        """
+        Yields the chunks of ``process(chunks)``, adding the time spent in
+        ``process`` itself, not in reading ``chunks``, to ``stage``.
+        """
+        read = [0.0, 0]
+
+        def timed(chunks):
+            chunks = iter(chunks)
+            while True:
+                started = time.time()
+                try:
+                    chunk = next(chunks)
+                finally:
+                    read[0] += time.time() - started
+                read[1] += len(chunk)
+                yield chunk
+
+        elapsed, output = 0.0, iter(process(timed(chunks)))
+        while True:
+            started = time.time()
+            try:
+                chunk = next(output)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.time() - started
+            yield chunk
+        self.stats.add(stage, elapsed - read[0], read[1])
+
     def cache_key(self, name):
-        return u'staticfiles:%s' % hashlib.md5(smart_str(name)).hexdigest()
+        return CACHE_KEY_PREFIX + hashlib.md5(smart_str(name)).hexdigest()
     
+    @property
+    def url_table(self):
+        """
+        Final URLs by name, built from the manifest and completed by the
+        url() calls for names of files, and rebuilt whenever the manifest
+        is replaced.
+        """
+        self.cache.refresh()
+        version = self.cache.version
+        if self._url_table is None or self._url_table_version != version:
+            self._url_table = self._build_url_table()
+            self._url_table_version = version
+        return self._url_table
+
+    def _build_url_table(self):
+        url_table = {}
+        for cache_key, hashed_name in self.cache.iteritems():
+            # the manifest only has digests of names, so guess each name
+            # back from its hashed name and keep the ones which check out
+            parsed_name = urlsplit(hashed_name)
+            match = self.hashed_path_re.match(parsed_name.path)
+            if match is None:
+                continue
+            name = match.group('root') + match.group('ext')
+            if parsed_name.query:
+                name += '?' + parsed_name.query
+            if self.cache_key(name) == cache_key:
+                final_url = super(HashedFilesStorage, self).url(hashed_name)
+                url_table[name] = unquote(final_url)
+        return url_table
+
     def url(self, name, force=False):
         """
         Returns the real URL in DEBUG mode.
         """
-        if settings.DEBUG and not force:
-            hashed_name, fragment = name, ''
-        else:
-            clean_name, fragment = urldefrag(name)
-            if urlsplit(clean_name).path.endswith('/'):  # don't hash paths
-                hashed_name = name
+        hashed = force or not settings.DEBUG
+        if hashed and self.url_table_enabled:
+            url_table = self.url_table
+            final_url = url_table.get(name)
+            if final_url is None:
+                final_url = self._url(name, hashed)
+                if self._tabled(name):
+                    url_table[name] = final_url
             else:
-                cache_key = self.cache_key(name)
-                hashed_name = self.cache.get(cache_key)
-                if hashed_name is None:
-                    hashed_name = self.hashed_name(clean_name).replace('\\', '/')
-                    # set the cache if there was a miss
-                    # (e.g. if cache server goes down)
-                    self.cache.set(cache_key, hashed_name)
+                self.stats.incr('url.table_hits')
+            return final_url
+        return self._url(name, hashed)
 
+    def urls(self, names, force=False):
+        """
+        Returns the URLs of ``names``, like url() does for every name, but
+        looks up all of them in the manifest at once.
+        """
+        hashed = force or not settings.DEBUG
+        url_table = None
+        if hashed and self.url_table_enabled:
+            url_table = self.url_table
+        final_urls = [None] * len(names)
+        parsed_names = []
+        for index, name in enumerate(names):
+            if url_table is not None:
+                final_urls[index] = url_table.get(name)
+                if final_urls[index] is not None:
+                    self.stats.incr('url.table_hits')
+                    continue
+            parsed_names.append((index, name) + self._parse_name(name, hashed))
+        cache_keys = [cache_key for index, name, clean_name, fragment, cache_key
+                      in parsed_names if cache_key is not None]
+        hashed_names = self.cache.get_many(cache_keys) if cache_keys else {}
+        for index, name, clean_name, fragment, cache_key in parsed_names:
+            hashed_name = self._hashed_name_for(name, clean_name, cache_key,
+                                                hashed_names.get(cache_key))
+            final_urls[index] = self._final_url(name, hashed_name, fragment)
+            if url_table is not None and self._tabled(name):
+                url_table[name] = final_urls[index]
+        return final_urls
+
+    def _tabled(self, name):
+        # only names of files go into the url table, as there is no end
+        # to the query strings and fragments which can be added to them
+        return not ('?' in name or '#' in name or name.endswith('/'))
+
+    def _url(self, name, hashed):
+        clean_name, fragment, cache_key = self._parse_name(name, hashed)
+        hashed_name = None
+        if cache_key is not None:
+            hashed_name = self.cache.get(cache_key)
+        hashed_name = self._hashed_name_for(name, clean_name, cache_key,
+                                            hashed_name)
+        return self._final_url(name, hashed_name, fragment)
+
+    def _parse_name(self, name, hashed):
+        """
+        Returns the name without its fragment, the fragment, and the cache
+        key of ``name`` if it is to be looked up in the manifest.
+        """
+        if not hashed:
+            return name, '', None
+        clean_name, fragment = urldefrag(name)
+        if urlsplit(clean_name).path.endswith('/'):  # don't hash paths
+            return clean_name, fragment, None
+        return clean_name, fragment, self.cache_key(name)
+
+    def _hashed_name_for(self, name, clean_name, cache_key, hashed_name):
+        if cache_key is None:
+            return name
+        if hashed_name is None:
+            self.stats.incr('url.misses')
+            hashed_name = self.hashed_name(clean_name).replace('\\', '/')
+            # set the cache if there was a miss
+            # (e.g. if cache server goes down)
+            self.cache.set(cache_key, hashed_name)
+        else:
+            self.stats.incr('url.hits')
+        return hashed_name
+
+    def _final_url(self, name, hashed_name, fragment):
         final_url = super(HashedFilesStorage, self).url(hashed_name)
 
         # Special casing for a @font-face hack, like url(myfont.eot?#iefix")
@@ -191,73 +2234,482 @@ class HashedFilesStorage(StaticFilesStorage):
 
         return unquote(final_url)
     
+    @property
+    def history_filename(self):
+        return self.cache.filename + '.history'
+
     def post_process(self, paths, dry_run=False, **options):
         # don't even dare to process the files if we're in dry run mode
         if dry_run:
             return
 
+        generation = set()
+        if self.shard is not None:
+            for result in self._post_process_shard(paths, generation):
+                yield result
+            return
+        if not getattr(settings, 'STATICFILES_GENERATIONS', 0):
+            for result in self._post_process(paths, generation):
+                yield result
+            return
+        # prune() must not delete files this run finds in the storage
+        # before they are recorded
+        with file_lock(self.history_filename + '.lock', shared=True):
+            for result in self._post_process(paths, generation):
+                yield result
+            self._add_generation(generation)
+
+    def _add_generation(self, names):
+        generations = getattr(settings, 'STATICFILES_GENERATIONS', 0)
+        history = GenerationHistory(self.history_filename)
+        history.append({'time': int(time.time()), 'names': sorted(names)})
+        del history[:-generations]
+        history.save()
+
+    def shard_filename(self, index, count):
+        return '%s.shard-%d-of-%d' % (self.cache.filename, index, count)
+
+    def _post_process_shard(self, paths, generation):
+        # the shard fills a manifest of its own in, which it saves as its
+        # partial manifest for merge_shards()
+        index, count = self.shard
+        if not 0 <= index < count:
+            raise ValueError("Invalid shard %d of %d." % (index, count))
+        filename = self.shard_filename(index, count)
+        shared, self._cache = self.cache, MemoryHashedCache()
+        try:
+            with file_lock(self.history_filename + '.lock', shared=True):
+                for result in self._post_process(paths, generation):
+                    yield result
+                partial = {
+                    'manifest': dict(self._cache.iteritems()),
+                    'names': sorted(generation),
+                }
+                atomic_write(filename, lambda sf: json.dump(partial, sf,
+                                                            sort_keys=True))
+        finally:
+            self._cache = shared
+
+    def merge_shards(self, count):
+        """
+        Combines the partial manifests of the ``count`` shards of a sharded
+        post_process into the manifest, which is then the same as the one a
+        single post_process of all files writes, and removes them.
+        """
+        manifest, names = {}, set()
+        filenames = [self.shard_filename(index, count) for index in xrange(count)]
+        for filename in filenames:
+            try:
+                with open(filename, 'r') as sf:
+                    partial = json.load(sf)
+            except (IOError, ValueError):
+                raise ValueError("The partial manifest '%s' is missing or "
+                                 "broken." % filename)
+            manifest.update(partial['manifest'])
+            names.update(partial['names'])
+        self.cache.clear()
+        self.cache.set_many(manifest)
+        if getattr(settings, 'STATICFILES_GENERATIONS', 0):
+            with file_lock(self.history_filename + '.lock', shared=True):
+                self._add_generation(names)
+        for filename in filenames:
+            os.unlink(filename)
+
+    def _post_process(self, paths, generation):
+        """
+        Post-processes ``paths``, or the files of the shard, and adds the
+        names of the files saved for them to the ``generation`` set.
+        """
+        started = time.time()
         self.cache.clear()
 
         # where to store the new paths
         hashed_paths = {}
 
-        processors = getattr(settings, 'STATICFILES_HASHED_PROCESSORS', 
-            DEFAULT_HASHED_PROCESSORS)
-        processors = [get_storage_class(p)(self) for p in processors]
-        processors = sorted(processors, 
-            key=lambda p: len(p.filepattern), reverse=True)
-        
+        self.deduplicate_mode = self._deduplicate_mode()
 
-        
-        # then sort the files by the directory level
-        path_level = lambda name: len(name.split(os.sep))
-        for name in sorted(paths.keys(), key=path_level, reverse=True):
+        # fingerprints of the files as they were on the last run
+        self.fingerprints = None
+        if getattr(settings, 'STATICFILES_INCREMENTAL', False):
+            filename = self.cache.filename
+            if self.shard is not None:
+                filename = self.shard_filename(*self.shard)
+            self.fingerprints = FingerprintIndex(filename + '.fingerprints',
+                                                 self.fingerprint_signature())
+            previous_names = set(self.fingerprints)
 
-            # use the original, local file, not the copied-but-unprocessed
-            # file, which might be somewhere far away, like S3
-            storage, path = paths[name]
-            for processor in processors:
-                if fnmatch.fnmatch(path, processor.filepattern):
-                    break
-            else:
-                processor = None
+        self.url_resolutions = UrlResolutions()
+        if self.integrity_algorithm:
+            self._integrities = {}
+        if self.deduplicate_mode is not None:
+            self._contents = {}
+        self._data_uris = {}
+        if getattr(settings, 'STATICFILES_INLINE_MAX_SIZE', 0):
+            self._inline_contents = {}
+        bundles = getattr(settings, 'STATICFILES_BUNDLES', {})
+        names = dict((name.replace(os.sep, '/'), name) for name in paths)
+        if bundles:
+            self._bundled = {}
+            for bundle, members in bundles.items():
+                for member in members:
+                    if member not in names:
+                        raise ValueError("The file '%s' of the bundle '%s' "
+                                         "was not collected." % (member, bundle))
+                    self._bundled[names[member]] = None
+        if getattr(settings, 'STATICFILES_PREFETCH_LISTING', False):
+            with self.stats.timer('storage.listdir'):
+                self._existing = self._list_all()
+        upload_workers = getattr(settings, 'STATICFILES_UPLOAD_WORKERS', 0)
+        if upload_workers:
+            self._uploads = UploadQueue(self, upload_workers,
+                getattr(settings, 'STATICFILES_UPLOAD_RETRIES', 3),
+                getattr(settings, 'STATICFILES_UPLOAD_BACKOFF', 0.5))
+        workers = getattr(settings, 'STATICFILES_POST_PROCESS_WORKERS', 1)
+        pool = ThreadPool(workers) if workers > 1 else None
+        imap = itertools.imap if pool is None else pool.imap
+        try:
+            # find out which files refer to which, and process the files
+            # a file refers to before the file itself, so that its hash
+            # covers the rewritten references
+            find = functools.partial(self._find_references, paths, names)
+            graph = dict(imap(find, paths.keys()))
+            duplicates = []
+            if self.deduplicate_mode == 'alias':
+                # files of the same content are aliased to the smallest of
+                # their hashed names, whichever is processed first and in
+                # whichever shard
+                duplicates = self._find_duplicates(paths, imap)
+                for group in duplicates:
+                    digest, hashed_name = group[0][:2]
+                    self._contents[digest] = hashed_name
+            if self.shard is not None:
+                # whole components of the reference graph, bundles and
+                # aliased files, so the files of the shard only refer to
+                # each other
+                index, count = self.shard
+                groups = [[names[member] for member in members]
+                          for members in bundles.values()]
+                groups.extend([name for digest, hashed_name, name in group]
+                              for group in duplicates)
+                shard = partition_references(graph, count, groups)[index]
+                graph = dict((name, graph[name]) for name in shard)
+                bundles = dict((bundle, members)
+                               for bundle, members in bundles.items()
+                               if all(names[member] in shard for member in members))
+            generation.update(name.replace(os.sep, '/') for name in graph)
+            process = functools.partial(self._post_process_component,
+                                        paths, graph)
+            compressible = []
+            for level in sort_references(graph):
+                for results in imap(process, level):
+                    for name, hashed_name, processed in results:
+                        # and then set the cache accordingly
+                        hashed_paths[self.cache_key(name)] = hashed_name
+                        generation.add(hashed_name)
+                        self.cache.update({self.cache_key(name): hashed_name})
+                        if self.compressible(name):
+                            compressible.append((name, hashed_name))
+                        yield name, hashed_name, processed
+            # bundles are built from the final contents of their files
+            for bundle, members in sorted(bundles.items()):
+                hashed_name, saved = self._bundle(
+                    bundle, [names[member] for member in members])
+                hashed_paths[self.cache_key(bundle)] = hashed_name
+                generation.add(hashed_name)
+                self.cache.update({self.cache_key(bundle): hashed_name})
+                if self.compressible(bundle):
+                    compressible.append((bundle, hashed_name))
+                yield bundle, hashed_name, saved
+            # precompressed variants of the final files, for web servers
+            # which serve them as they are (e.g. nginx's gzip_static), are
+            # read back from the storage once their uploads are done
+            if compressible and self._uploads is not None:
+                with self.stats.timer('storage.upload_wait'):
+                    self._uploads.wait()
+            for variants in imap(self._compress, compressible):
+                for name, hashed_name in variants:
+                    hashed_paths[self.cache_key(name)] = hashed_name
+                    generation.add(hashed_name)
+            if self._integrities is not None:
+                for name, integrity in self._integrities.iteritems():
+                    hashed_paths[self.integrity_key(name)] = integrity
+            # the manifest must not refer to files which failed to upload
+            if self._uploads is not None:
+                with self.stats.timer('storage.upload_wait'):
+                    self._uploads.join()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if self._uploads is not None:
+                self._uploads.terminate()
+            self._uploads = self._existing = None
+            resolutions, self.url_resolutions = self.url_resolutions, None
+            self._contents = self._integrities = self._data_uris = None
+            self._inline_contents = None
+            self._bundled = None
+            logger.info("Resolved %d URL references, %d of them repeated",
+                        resolutions.hits + resolutions.misses, resolutions.hits)
+            self.url_resolution_stats = {
+                'hits': resolutions.hits,
+                'misses': resolutions.misses,
+            }
+
+        # Finally set the cache
+        with self.stats.timer('manifest.save'):
+            self.cache.set_many(hashed_paths)
+        if self.fingerprints is not None:
+            for name in previous_names.difference(graph):
+                del self.fingerprints[name]
+            self.fingerprints.save()
+        self.stats.add('post_process', time.time() - started)
+        post_processed.send(sender=self.__class__, storage=self,
+                            stats=self.stats)
 
+    def _bundle(self, bundle, members):
+        """
+        Saves the final contents of ``members`` joined as ``bundle``, with
+        their relative URLs rebased to its directory. Returns its hashed
+        name and whether it was saved, i.e. changed.
+        """
+        separator = ';\n' if bundle.endswith('.js') else '\n'
+        directory = posixpath.dirname(bundle)
+        contents = []
+        for member in members:
+            content = self._bundled.get(member)
+            if content is None:
+                # not saved by this run, see _unchanged
+                with self.open(self.cache.get(self.cache_key(member))) as f:
+                    content = f.read()
+            processor = self.processor_for(member)
+            if processor is not None:
+                content = processor.rebase(member, content, directory)
+            contents.append(content)
+        content = ChunkedContent([separator.join(contents)])
+        with self.stats.timer('bundle'):
+            return self._save_hashed(bundle, content, aliasable=False)[1:]
+
+    def _bundle_chunks(self, name, chunks):
+        """
+        Returns ``chunks`` of ``name``, kept as they are read if the file
+        is in a bundle.
+        """
+        if self._bundled is None or name not in self._bundled:
+            return chunks
+        return self._keep_chunks(name, chunks)
+
+    def _keep_chunks(self, name, chunks):
+        kept = []
+        for chunk in chunks:
+            kept.append(chunk)
+            yield chunk
+        self._bundled[name] = ''.join(kept)
+
+    def compressible(self, name):
+        if not getattr(settings, 'STATICFILES_COMPRESS', False):
+            return False
+        if self._compress_re is None:
+            patterns = getattr(settings, 'STATICFILES_COMPRESS_PATTERNS',
+                               DEFAULT_COMPRESS_PATTERNS)
+            self._compress_re = re.compile(
+                '|'.join(fnmatch.translate(pattern) for pattern in patterns))
+        return self._compress_re.match(name) is not None
+
+    def _compress(self, item):
+        """
+        Saves the compressed variants of ``hashed_name`` which are at least
+        STATICFILES_COMPRESS_MIN_RATIO times smaller than it, and returns
+        their names and hashed names, e.g. ``(name + '.gz', hashed_name +
+        '.gz')``. Hashed names are content addressed, so existing variants
+        are up to date.
+        """
+        name, hashed_name = item
+        formats = getattr(settings, 'STATICFILES_COMPRESS_FORMATS', ('gz', 'br'))
+        min_ratio = getattr(settings, 'STATICFILES_COMPRESS_MIN_RATIO', 1.1)
+        content, variants = None, []
+        for extension in formats:
+            if extension == 'br' and brotli is None:
+                continue
+            variant = '%s.%s' % (hashed_name, extension)
+            with self.stats.timer('storage.exists'):
+                exists = self.exists(variant)
+            if not exists:
+                if content is None:
+                    with self.open(hashed_name) as hashed_file:
+                        content = hashed_file.read()
+                with self.stats.timer('compress.%s' % extension, len(content)):
+                    compressed = COMPRESSORS[extension](content)
+                if len(compressed) * min_ratio > len(content):
+                    continue
+                self._upload(variant, ContentFile(compressed))
+            variants.append(('%s.%s' % (name, extension), variant))
+        return variants
+
+    def _find_references(self, paths, names, name):
+        storage, path = paths[name]
+        processor = self.processor_for(path)
+        if processor is None:
+            return name, set()
+        fingerprint = self._fingerprint(name)
+        if fingerprint and fingerprint['stat'] == self._source_stat(storage, path):
+            return name, set(fingerprint['references'])
+        with storage.open(path) as original_file:
+            content = original_file.read()
+        with self.stats.timer('references', len(content)):
+            references = processor.references(name, content)
+            references = set(names.get(urlsplit(url).path) for url in references)
+        references.discard(None)
+        return name, references
+
+    def _find_duplicates(self, paths, imap):
+        """
+        Returns the groups of files no processor changes which have the
+        same content, as lists of (digest, hashed name, name) sorted by
+        hashed name.
+        """
+        contents = {}
+        for item in imap(functools.partial(self._source_digest, paths), paths):
+            if item is not None:
+                contents.setdefault(item[0], []).append(item)
+        return sorted(sorted(group) for group in contents.itervalues()
+                      if len(group) > 1)
+
+    def _source_digest(self, paths, name):
+        storage, path = paths[name]
+        if self.processor_for(path) is not None:
+            return None
+        with storage.open(path) as original_file:
+            digest = self.file_hash(original_file)
+        return digest, self.hashed_name(name, file_hash=digest), name
+
+    def _post_process_component(self, paths, graph, component):
+        if len(component) == 1 and component[0] not in graph[component[0]]:
+            name = component[0]
+            hashed_name = self._unchanged(paths, graph, name)
+            if hashed_name is not None:
+                return [(name, hashed_name, False)]
+            return [self._post_process_file(paths, name, graph=graph)]
+
+        # the files of a cycle can't all come after each other, so they
+        # are named by their original content and refer to those names
+        warnings.warn("Reference cycle between %s, these files are hashed "
+                      "from their original content" % ', '.join(component),
+                      CyclicReferenceWarning)
+        hashed_names = {}
+        for name in component:
+            storage, path = paths[name]
             with storage.open(path) as original_file:
+                hashed_names[name] = self.hashed_name(name, original_file)
+        self.cache.update(dict((self.cache_key(name), hashed_name)
+                               for name, hashed_name in hashed_names.items()))
+        return [self._post_process_file(paths, name, hashed_names[name])
+                for name in component]
 
-                # generate the hash with the original content, even for
-                # adjustable files.
-                hashed_name = self.hashed_name(name, original_file)
+    def _source_stat(self, storage, path):
+        try:
+            stat = os.stat(storage.path(path))
+        except NotImplementedError:
+            modified_time = storage.modified_time(path)
+            return [storage.size(path), time.mktime(modified_time.timetuple())]
+        return [stat.st_size, stat.st_mtime]
+
+    def fingerprint_signature(self):
+        """
+        Returns a digest of the settings which change the hashed files
+        post_process saves for the same sources, so that fingerprints
+        recorded with other ones aren't trusted.
+        """
+        signature = [
+            self.hash_algorithm,
+            self.hash_length,
+            self.integrity_algorithm,
+            list(getattr(settings, 'STATICFILES_HASHED_PROCESSORS',
+                         DEFAULT_HASHED_PROCESSORS)),
+            getattr(settings, 'STATIC_JSPROCESSOR_TEMPLATE', None),
+            getattr(settings, 'STATICFILES_INLINE_MAX_SIZE', 0),
+            list(getattr(settings, 'STATICFILES_INLINE_TYPES',
+                         DEFAULT_INLINE_TYPES)),
+            self.deduplicate_mode,
+        ]
+        return hashlib.md5(json.dumps(signature)).hexdigest()
 
-                # then get the original's file content..
-                if hasattr(original_file, 'seek'):
-                    original_file.seek(0)
+    def _fingerprint(self, name):
+        if self.fingerprints is None:
+            return None
+        return self.fingerprints.get(name)
 
-                hashed_file_exists = self.exists(hashed_name)
-                processed = False
+    def _unchanged(self, paths, graph, name):
+        """
+        Returns the hashed name ``name`` got on the last run if neither the
+        file nor any file it refers to changed since, None otherwise.
+        """
+        fingerprint = self._fingerprint(name)
+        if fingerprint is None:
+            return None
+        for reference in graph[name]:
+            hashed_reference = self.cache.get(self.cache_key(reference))
+            if fingerprint['references'].get(reference) != hashed_reference:
+                return None
+        if not self.exists(fingerprint['hashed_name']):
+            return None
+        if self._integrities is not None:
+            if fingerprint.get('integrity') is None:
+                return None
+            self._add_integrity(name, fingerprint['integrity'])
+        storage, path = paths[name]
+        stat = self._source_stat(storage, path)
+        if fingerprint['stat'] != stat:
+            # touched, but maybe not changed
+            with storage.open(path) as original_file:
+                if self.file_hash(original_file) != fingerprint['digest']:
+                    return None
+            fingerprint['stat'] = stat
+        return fingerprint['hashed_name']
 
-                # ..to apply each replacement pattern to the content
-                if processor:
-                    content = original_file.read()
-                    content = processor.process(name, content)
-                    if hashed_file_exists:
-                        self.delete(hashed_name)
+    def _post_process_file(self, paths, name, hashed_name=None, graph=None):
+        # use the original, local file, not the copied-but-unprocessed
+        # file, which might be somewhere far away, like S3
+        storage, path = paths[name]
+        processor = self.processor_for(path)
+        if self.fingerprints is not None:
+            stat = self._source_stat(storage, path)
 
-                    # then save the processed result
-                    content_file = ContentFile(smart_str(content))
-                    saved_name = self._save(hashed_name, content_file)
-                    hashed_name = force_unicode(saved_name.replace('\\', '/'))
-                    processed = True
-                else:
-                    # or handle the case in which neither processing nor
-                    # a change to the original file happened
-                    if not hashed_file_exists:
-                        processed = True
-                        saved_name = self._save(hashed_name, original_file)
-                        hashed_name = force_unicode(saved_name.replace('\\', '/'))
+        with storage.open(path) as original_file:
+            processed = False
 
-                # and then set the cache accordingly
-                hashed_paths[self.cache_key(name)] = hashed_name
-                yield name, hashed_name, processed
+            # stream the content through the processors, hashing the
+            # original and the processed chunks as they pass, and save
+            # the result under the hash of the processed content, unless
+            # it duplicates a file saved before (which can't be aliased,
+            # relative URLs in it only work from its own directory)
+            if processor:
+                hasher = self.new_hash()
+                chunks = hash_chunks(original_file.chunks(), hasher)
+                content = ChunkedContent(self._bundle_chunks(
+                    name, self.process_chunks(processor, name, chunks)))
+                hashed_name = self._save_hashed(name, content, hashed_name,
+                                                aliasable=False)[1]
+                digest = hasher.hexdigest()
+                processed = True
+            else:
+                # or handle the case in which neither processing nor
+                # a change to the original file happened
+                content = original_file
+                if self._bundled is not None and name in self._bundled:
+                    content = ChunkedContent(
+                        self._bundle_chunks(name, original_file.chunks()))
+                with self.stats.timer('copy'):
+                    digest, hashed_name, processed = self._save_hashed(
+                        name, content)
 
-        # Finally set the cache
-        self.cache.set_many(hashed_paths)
+        if self.fingerprints is not None and graph is not None:
+            references = dict((reference, self.cache.get(self.cache_key(reference)))
+                              for reference in graph[name])
+            self.fingerprints[name] = {
+                'stat': stat,
+                'digest': digest,
+                'references': references,
+                'hashed_name': hashed_name,
+                'integrity': (self._integrities or {}).get(name),
+            }
+        return name, hashed_name, processed
@@ -0,0 +1,70 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.staticfiles.management.commands import collectstatic
+from django.core.management.base import CommandError
+from django.utils.encoding import smart_str
+
+from django_staticstorages import Stats
+
+
+class Command(collectstatic.Command):
+    """
+    collectstatic which can report where post-processing spends its time,
+    and post-process one shard of the files. Shard runs don't copy the
+    files, which a run without --shard does once before them.
+    """
+    option_list = collectstatic.Command.option_list + (
+        make_option('--stats',
+            action='store_true', dest='stats', default=False,
+            help="Print the time and bytes of every post-processing stage."),
+        make_option('--shard', dest='shard', default=None, metavar='INDEX/COUNT',
+            help="Only post-process shard INDEX (0 to COUNT - 1) of COUNT and "
+                 "save its partial manifest, see mergestatic. The files are "
+                 "not copied, run collectstatic --no-post-process first."),
+    )
+
+    def set_options(self, **options):
+        super(Command, self).set_options(**options)
+        self.stats = options.get('stats', False)
+        self.shard = shard = options.get('shard')
+        if shard:
+            try:
+                shard = tuple(int(part) for part in shard.split('/'))
+                index, count = shard
+            except ValueError:
+                raise CommandError("--shard must be INDEX/COUNT, e.g. 0/4.")
+            if not hasattr(self.storage, 'merge_shards'):
+                raise CommandError("--shard requires STATICFILES_STORAGE to "
+                                   "be a django_staticstorages.HashedFilesStorage.")
+            if self.clear:
+                # the shards run concurrently, after the files were copied
+                raise CommandError("--clear can't be combined with --shard.")
+            self.storage.shard = shard
+
+    def copy_file(self, path, prefixed_path, source_storage):
+        if self.shard:
+            return self.log(u"Skipping '%s' (not copied by shards)" % path)
+        return super(Command, self).copy_file(path, prefixed_path, source_storage)
+
+    def link_file(self, path, prefixed_path, source_storage):
+        if self.shard:
+            return self.log(u"Skipping '%s' (not linked by shards)" % path)
+        return super(Command, self).link_file(path, prefixed_path, source_storage)
+
+    def collect(self):
+        if self.stats and hasattr(self.storage, 'stats'):
+            if not self.storage.stats.enabled:
+                self.storage.stats = Stats()
+            self.storage.stats.reset()
+        return super(Command, self).collect()
+
+    def handle_noargs(self, **options):
+        try:
+            super(Command, self).handle_noargs(**options)
+        finally:
+            if options.get('shard') and hasattr(self.storage, 'merge_shards'):
+                # the storage outlives the command
+                self.storage.shard = getattr(settings, 'STATICFILES_SHARD', None)
+        if self.stats and hasattr(self.storage, 'stats'):
+            self.stdout.write(smart_str(self.storage.stats.report()))
@@ -0,0 +1,27 @@
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.encoding import smart_str
+
+
+class Command(BaseCommand):
+    """
+    Combines the partial manifests of a sharded collectstatic.
+    """
+    args = '<count>'
+    help = ("Combines the partial manifests of the COUNT shards which "
+            "collectstatic --shard INDEX/COUNT saved into the manifest.")
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or not args[0].isdigit():
+            raise CommandError("Usage: mergestatic %s" % self.args)
+        if not hasattr(staticfiles_storage, 'merge_shards'):
+            raise CommandError("mergestatic requires STATICFILES_STORAGE to "
+                               "be a django_staticstorages.HashedFilesStorage.")
+        count = int(args[0])
+        try:
+            staticfiles_storage.merge_shards(count)
+        except ValueError, e:
+            raise CommandError(str(e))
+        if int(options.get('verbosity', 1)) >= 1:
+            self.stdout.write(smart_str(u"Merged the manifests of %d shards.\n"
+                                        % count))
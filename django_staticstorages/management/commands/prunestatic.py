@@ -0,0 +1,47 @@
+from optparse import make_option
+
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import CommandError, NoArgsCommand
+from django.utils.encoding import smart_str
+
+
+class Command(NoArgsCommand):
+    """
+    Deletes the hashed files the last post_process runs no longer refer to.
+    """
+    help = ("Deletes hashed static files which neither the manifest nor the "
+            "generations recorded with STATICFILES_GENERATIONS refer to.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--keep', type='int', dest='keep', default=None,
+            help="Keep the files of the last KEEP generations only "
+                 "(default: all recorded generations)."),
+        make_option('--min-age', type='int', dest='min_age', default=3600,
+            help="Keep files modified less than MIN_AGE seconds ago "
+                 "(default: 3600)."),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+            help="Delete BATCH_SIZE files at a time (default: 1000)."),
+        make_option('-n', '--dry-run', action='store_true', dest='dry_run',
+            default=False, help="List the files instead of deleting them."),
+    )
+
+    def handle_noargs(self, **options):
+        if not hasattr(staticfiles_storage, 'prune'):
+            raise CommandError("prunestatic requires STATICFILES_STORAGE to "
+                               "be a django_staticstorages.HashedFilesStorage.")
+        verbosity = int(options.get('verbosity', 1))
+        dry_run = options['dry_run']
+        count = 0
+        try:
+            for name in staticfiles_storage.prune(
+                    keep=options['keep'], min_age=options['min_age'],
+                    batch_size=options['batch_size'], dry_run=dry_run):
+                count += 1
+                if verbosity >= 2:
+                    self.stdout.write(smart_str(u"%s '%s'\n" % (
+                        'Pretending to delete' if dry_run else 'Deleting', name)))
+        except ValueError, e:
+            raise CommandError(str(e))
+        if verbosity >= 1:
+            self.stdout.write(smart_str(u"%d stale static file%s %s.\n" % (
+                count, '' if count == 1 else 's',
+                'would be deleted' if dry_run else 'deleted')))
@@ -0,0 +1,41 @@
+from django import template
+from django.contrib.staticfiles.storage import staticfiles_storage
+
+register = template.Library()
+
+
+@register.assignment_tag
+def static_urls(*names):
+    """
+    Resolves the URLs of several static files with one manifest lookup::
+
+        {% load staticstorages %}
+        {% static_urls 'css/main.css' 'js/main.js' as urls %}
+
+    Lists and tuples among the arguments are expanded, so a list of names
+    prepared by a view can be passed as well.
+    """
+    flat_names = []
+    for name in names:
+        if isinstance(name, (list, tuple)):
+            flat_names.extend(name)
+        else:
+            flat_names.append(name)
+    urls = getattr(staticfiles_storage, 'urls', None)
+    if urls is None:
+        return [staticfiles_storage.url(name) for name in flat_names]
+    return urls(flat_names)
+
+
+@register.simple_tag
+def static_integrity(name):
+    """
+    Renders the Subresource Integrity value of a static file::
+
+        <script src="{% static 'js/main.js' %}"
+                integrity="{% static_integrity 'js/main.js' %}"></script>
+    """
+    integrity = getattr(staticfiles_storage, 'integrity', None)
+    if integrity is None:
+        return ''
+    return integrity(name) or ''
@@ -5,20 +5,30 @@ if __name__ == '__main__':
     import os
     os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
 
+import base64
 import codecs
+import gzip
+import hashlib
+import json
+import multiprocessing
 import os
 import posixpath
 import shutil
 import sys
 import tempfile
+import threading
+import time
+import traceback
 import warnings
 from StringIO import StringIO
 
 from django.template import loader, Context
 from django.conf import settings
+from django.core.cache import get_cache
 from django.core.cache.backends.base import BaseCache, CacheKeyWarning
 from django.core.exceptions import ImproperlyConfigured
-from django.core.files.storage import default_storage
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage, FileSystemStorage
 from django.core.management import call_command
 from django.test import TestCase
 from django.test.utils import override_settings
@@ -27,6 +37,13 @@ from django.utils.functional import empty
 from django.utils._os import rmtree_errorhandler
 
 from django.contrib.staticfiles import finders, storage
+from django.contrib.staticfiles.storage import staticfiles_storage
+
+from django_staticstorages import (BaseProcessor, CssProcessor,
+    CyclicReferenceWarning, DjangoCacheHashedCache, GenerationHistory,
+    HashedCache, HashedFilesStorage, JsProcessor, ManifestIndex,
+    ProcessorChain, ProcessorIndex, SourceMapProcessor, SqliteHashedCache,
+    gzip_compress, partition_references, post_processed, sort_references)
 
 TEST_ROOT = os.path.dirname(__file__)
 from django.contrib.staticfiles.management.commands.collectstatic import Command as CollectstaticCommand
@@ -139,7 +156,7 @@ class TestCollectionCachedStorage(BaseCollectionTestCase,
         self.assertStaticRenders("test/file.txt",
                                  "/static/test/file.ea5bccaf16d5.txt")
         self.assertStaticRenders("styles.css",
-                                 "/static/styles.93b1147e8552.css")
+                                 "/static/styles.f3c91a839dc2.css")
         self.assertStaticRenders("path/",
                                  "/static/path/")
         self.assertStaticRenders("path/?query",
@@ -147,7 +164,7 @@ class TestCollectionCachedStorage(BaseCollectionTestCase,
 
     def test_template_tag_simple_content(self):
         relpath = self.cached_file_path("styles.css")
-        self.assertEqual(relpath, "styles.93b1147e8552.css")
+        self.assertEqual(relpath, "styles.f3c91a839dc2.css")
         with storage.staticfiles_storage.open(relpath) as relfile:
             content = relfile.read()
             self.assertNotIn("cached/other.css", content)
@@ -156,25 +173,25 @@ class TestCollectionCachedStorage(BaseCollectionTestCase,
     def test_path_with_querystring(self):
         relpath = self.cached_file_path("styles.css?spam=eggs")
         self.assertEqual(relpath,
-                         "styles.93b1147e8552.css?spam=eggs")
+                         "styles.f3c91a839dc2.css?spam=eggs")
         with storage.staticfiles_storage.open(
-                "styles.93b1147e8552.css") as relfile:
+                "styles.f3c91a839dc2.css") as relfile:
             content = relfile.read()
             self.assertNotIn("other.css", content)
             self.assertIn("other.d41d8cd98f00.css", content)
 
     def test_path_with_fragment(self):
         relpath = self.cached_file_path("styles.css#eggs")
-        self.assertEqual(relpath, "styles.93b1147e8552.css#eggs")
+        self.assertEqual(relpath, "styles.f3c91a839dc2.css#eggs")
         with storage.staticfiles_storage.open(
-                "styles.93b1147e8552.css") as relfile:
+                "styles.f3c91a839dc2.css") as relfile:
             content = relfile.read()
             self.assertNotIn("other.css", content)
             self.assertIn("other.d41d8cd98f00.css", content)
 
     def test_path_with_querystring_and_fragment(self):
         relpath = self.cached_file_path("css/fragments.css")
-        self.assertEqual(relpath, "css/fragments.75433540b096.css")
+        self.assertEqual(relpath, "css/fragments.2c448f4a41e1.css")
         with storage.staticfiles_storage.open(relpath) as relfile:
             content = relfile.read()
             self.assertIn('fonts/font.a4b0478549d0.eot?#iefix', content)
@@ -184,37 +201,37 @@ class TestCollectionCachedStorage(BaseCollectionTestCase,
 
     def test_template_tag_absolute(self):
         relpath = self.cached_file_path("absolute.css")
-        self.assertEqual(relpath, "absolute.b094e4c60b0e.css")
+        self.assertEqual(relpath, "absolute.2bcf9bd22a87.css")
         with storage.staticfiles_storage.open(relpath) as relfile:
             content = relfile.read()
             self.assertNotIn("/static/styles.css", content)
-            self.assertIn("/static/styles.93b1147e8552.css", content)
+            self.assertIn("/static/styles.f3c91a839dc2.css", content)
             self.assertIn('/static/img/relative.acae32e4532b.png', content)
 
     def test_template_tag_denorm(self):
         relpath = self.cached_file_path("denorm.css")
-        self.assertEqual(relpath, "denorm.7394833810b4.css")
+        self.assertEqual(relpath, "denorm.1a9089f2349d.css")
         with storage.staticfiles_storage.open(relpath) as relfile:
             content = relfile.read()
             self.assertNotIn("..///styles.css", content)
-            self.assertIn("../styles.93b1147e8552.css", content)
+            self.assertIn("../styles.f3c91a839dc2.css", content)
             self.assertNotIn("url(img/relative.png )", content)
             self.assertIn('url("img/relative.acae32e4532b.png', content)
 
     def test_template_tag_relative(self):
         relpath = self.cached_file_path("relative.css")
-        self.assertEqual(relpath, "relative.2f2aea7a52dd.css")
+        self.assertEqual(relpath, "relative.10227adbaa2c.css")
         with storage.staticfiles_storage.open(relpath) as relfile:
             content = relfile.read()
             self.assertNotIn("./styles.css", content)
             self.assertNotIn('@import "styles.css"', content)
             self.assertNotIn('url(img/relative.png)', content)
             self.assertIn('url("img/relative.acae32e4532b.png")', content)
-            self.assertIn("styles.93b1147e8552.css", content)
+            self.assertIn("styles.f3c91a839dc2.css", content)
 
     def test_template_tag_deep_relative(self):
         relpath = self.cached_file_path("css/window.css")
-        self.assertEqual(relpath, "css/window.9db38d5169f3.css")
+        self.assertEqual(relpath, "css/window.335bb256341d.css")
         with storage.staticfiles_storage.open(relpath) as relfile:
             content = relfile.read()
             self.assertNotIn('url(img/window.png)', content)
@@ -228,7 +245,7 @@ class TestCollectionCachedStorage(BaseCollectionTestCase,
 
     def test_cache_invalidation(self):
         name = "styles.css"
-        hashed_name = "styles.93b1147e8552.css"
+        hashed_name = "styles.f3c91a839dc2.css"
         # check if the cache is filled correctly as expected
         cache_key = storage.staticfiles_storage.cache_key(name)
         cached_name = storage.staticfiles_storage.cache.get(cache_key)
@@ -267,6 +284,137 @@ class TestCollectionCachedStorage(BaseCollectionTestCase,
         self.assertTrue(os.path.join('css', 'window.css') in stats['post_processed'])
         self.assertTrue(os.path.join('css', 'img', 'window.png') in stats['unmodified'])
 
+    def test_parallel_post_processing(self):
+        serial = dict(storage.staticfiles_storage.cache.items())
+        with override_settings(STATICFILES_POST_PROCESS_WORKERS=4):
+            self.run_collectstatic(clear=True)
+        parallel = dict(storage.staticfiles_storage.cache.items())
+        self.assertEqual(parallel, serial)
+        self.assertEqual(self.cached_file_path("css/window.css"),
+                         "css/window.335bb256341d.css")
+
+    def test_url_table(self):
+        names = ['styles.css', 'styles.css?spam=eggs', 'styles.css#eggs',
+                 'css/fragments.css', 'css/fonts/font.eot?#iefix',
+                 'test/file.txt', 'path/']
+        expected = [storage.staticfiles_storage.url(name) for name in names]
+        with override_settings(STATICFILES_URL_TABLE=True):
+            tabled = HashedFilesStorage()
+        self.assertEqual(tabled.url_table['css/window.css'],
+                         '/static/css/window.335bb256341d.css')
+        self.assertEqual([tabled.url(name) for name in names], expected)
+        self.assertEqual(tabled.urls(names), expected)
+        # from now on every file name is a single lookup, names with a
+        # query string or fragment don't fill up the table
+        self.assertEqual([name for name in names if name in tabled.url_table],
+                         ['styles.css', 'css/fragments.css', 'test/file.txt'])
+        tabled.cache_key = None
+        self.assertEqual(tabled.url('test/file.txt'), expected[5])
+        # until the manifest changes
+        tabled.cache.clear()
+        self.assertRaises(TypeError, tabled.url, 'styles.css')
+
+    def test_manifest_backends(self):
+        names = ['styles.css', 'css/window.css', 'test/file.txt']
+        expected = storage.staticfiles_storage.urls(names)
+        serial = dict(storage.staticfiles_storage.cache.items())
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, ignore_errors=True)
+        for backend in ('django_staticstorages.DjangoCacheHashedCache',
+                        'django_staticstorages.SqliteHashedCache'):
+            with override_settings(STATIC_CACHE_BACKEND=backend,
+                    STATIC_CACHE_FILE=os.path.join(tmpdir, 'static.sqlite3')):
+                storage.staticfiles_storage._wrapped = empty
+                self.run_collectstatic(clear=True)
+                self.assertEqual(dict(storage.staticfiles_storage.cache.items()),
+                                 serial)
+                self.assertEqual(HashedFilesStorage().urls(names), expected)
+            storage.staticfiles_storage._wrapped = empty
+
+    def test_stats(self):
+        self.assertFalse(storage.staticfiles_storage.stats.enabled)
+        received = []
+        def receiver(sender, storage, stats, **kwargs):
+            received.append(dict(stats.stages))
+        post_processed.connect(receiver)
+        self.addCleanup(post_processed.disconnect, receiver)
+        out = StringIO()
+        call_command('collectstatic', interactive=False, verbosity='0',
+                     ignore_patterns=['*.ignoreme'], stats=True, stdout=out)
+        stages = received[0]
+        self.assertTrue(stages['process.CssProcessor'][0] >=
+                        stages['references'][0] > 0)
+        self.assertTrue(stages['process.CssProcessor'][2] > 0)
+        self.assertEqual(stages['manifest.save'][0], 1)
+        self.assertIn('copy', stages)
+        report = out.getvalue()
+        self.assertIn('process.CssProcessor', report)
+        self.assertIn('url.misses', report)
+
+        stats = storage.staticfiles_storage.stats
+        stats.reset()
+        storage.staticfiles_storage.url('styles.css')
+        storage.staticfiles_storage.url('styles.css')
+        self.assertEqual(stats.counters, {'url.hits': 2})
+
+    def test_prunestatic(self):
+        history_filename = storage.staticfiles_storage.history_filename
+        for filename in (history_filename, history_filename + '.lock'):
+            self.addCleanup(lambda filename=filename: os.path.exists(filename)
+                            and os.unlink(filename))
+        # commands exit on errors in this version of Django
+        self.assertRaises(SystemExit, call_command, 'prunestatic',
+                          verbosity=0, stderr=StringIO())
+        with override_settings(STATICFILES_GENERATIONS=1):
+            self.run_collectstatic()
+        stale = os.path.join(settings.STATIC_ROOT, 'test', 'stale.0123456789ab.txt')
+        with open(stale, 'w') as stale_file:
+            stale_file.write('stale')
+        out = StringIO()
+        call_command('prunestatic', min_age=0, stdout=out)
+        self.assertEqual(out.getvalue(), '1 stale static file deleted.\n')
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(os.path.join(
+            settings.STATIC_ROOT, 'test', 'file.ea5bccaf16d5.txt')))
+
+    def test_sharded_collectstatic(self):
+        staticfiles_storage = storage.staticfiles_storage
+        with open(staticfiles_storage.cache.filename, 'rb') as manifest_file:
+            manifest = manifest_file.read()
+        os.unlink(staticfiles_storage.cache.filename)
+        # the files were copied by the run without --shard
+        os.unlink(os.path.join(settings.STATIC_ROOT, 'test', 'file.txt'))
+        for index in range(2):
+            self.run_collectstatic(shard='%d/2' % index)
+            self.assertTrue(os.path.exists(
+                staticfiles_storage.shard_filename(index, 2)))
+        self.assertEqual(staticfiles_storage.shard, None)
+        self.assertFalse(os.path.exists(
+            os.path.join(settings.STATIC_ROOT, 'test', 'file.txt')))
+        call_command('mergestatic', '2', verbosity=0)
+        with open(staticfiles_storage.cache.filename, 'rb') as manifest_file:
+            self.assertEqual(manifest_file.read(), manifest)
+        # and --clear would delete the files of the other shards
+        self.assertRaises(SystemExit, self.run_collectstatic,
+                          shard='0/2', clear=True)
+
+    def test_bulk_urls(self):
+        names = ['styles.css', 'styles.css?spam=eggs', 'styles.css#eggs',
+                 'css/fonts/font.eot?#iefix', 'test/file.txt', 'path/']
+        staticfiles_storage = storage.staticfiles_storage
+        expected = [staticfiles_storage.url(name) for name in names]
+        lookups = []
+        get_many = staticfiles_storage.cache.get_many
+        staticfiles_storage.cache.get_many = lambda keys: lookups.append(keys) or get_many(keys)
+        self.assertEqual(staticfiles_storage.urls(names), expected)
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual(len(lookups[0]), 5)
+        self.assertEqual(self.render_template(
+            "{% load staticstorages %}"
+            "{% static_urls 'styles.css' names as urls %}"
+            "{{ urls|join:',' }}", names=['test/file.txt', 'path/']),
+            ','.join([expected[0], expected[4], expected[5]]))
+
     def test_cache_key_memcache_validation(self):
         """
         Handle cache key creation correctly, see #17861.
@@ -281,6 +429,1031 @@ class TestCollectionCachedStorage(BaseCollectionTestCase,
         self.assertEqual(cache_key, 'staticfiles:e95bbc36387084582df2a70750d7b351')
 
 
+class CountingHashedFilesStorage(HashedFilesStorage):
+    opened = 0
+
+    def _open(self, name, mode='rb'):
+        self.opened += 1
+        return super(CountingHashedFilesStorage, self)._open(name, mode)
+
+
+class CountingFileSystemStorage(FileSystemStorage):
+    opened = 0
+
+    def _open(self, name, mode='rb'):
+        self.opened += 1
+        return super(CountingFileSystemStorage, self)._open(name, mode)
+
+
+class LatentFileSystemStorage(FileSystemStorage):
+    """
+    Local stand-in for a remote storage: every call is a slow round trip,
+    and saves can be made to fail.
+    """
+    latency = 0.005
+
+    def __init__(self, *args, **kwargs):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.uploading = self.max_uploading = 0
+        # failures left by the start of the names to fail
+        self.failures = {}
+        super(LatentFileSystemStorage, self).__init__(*args, **kwargs)
+
+    def round_trip(self, call):
+        with self.lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+        time.sleep(self.latency)
+
+    def exists(self, name):
+        self.round_trip('exists')
+        return super(LatentFileSystemStorage, self).exists(name)
+
+    def listdir(self, path):
+        self.round_trip('listdir')
+        return super(LatentFileSystemStorage, self).listdir(path)
+
+    def delete(self, name):
+        self.round_trip('delete')
+        return super(LatentFileSystemStorage, self).delete(name)
+
+    def _save(self, name, content):
+        with self.lock:
+            self.uploading += 1
+            self.max_uploading = max(self.max_uploading, self.uploading)
+            failing = [prefix for prefix, count in self.failures.items()
+                       if count and name.startswith(prefix)]
+            for prefix in failing:
+                self.failures[prefix] -= 1
+        try:
+            self.round_trip('save')
+            if failing:
+                raise IOError('connection reset')
+            return super(LatentFileSystemStorage, self)._save(name, content)
+        finally:
+            with self.lock:
+                self.uploading -= 1
+
+
+class LatentHashedFilesStorage(HashedFilesStorage, LatentFileSystemStorage):
+    # saves to fail during post_process
+    post_process_failures = {}
+
+    def post_process(self, paths, **options):
+        # only count the calls of post_process
+        self.calls.clear()
+        self.failures = dict(self.post_process_failures)
+        return super(LatentHashedFilesStorage, self).post_process(paths, **options)
+
+
+class SlowUploadHashedFilesStorage(LatentHashedFilesStorage):
+    # only saves are round trips, and slow ones
+    latency = 0.05
+
+    def round_trip(self, call):
+        if call == 'save':
+            super(SlowUploadHashedFilesStorage, self).round_trip(call)
+
+
+def post_process_shard(paths, shard):
+    """
+    Post-processes ``shard`` of ``paths`` in a forked process.
+    """
+    try:
+        warnings.simplefilter('ignore')
+        storage = HashedFilesStorage()
+        storage.shard = shard
+        for result in storage.post_process(paths):
+            pass
+    except BaseException:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+
+class TestPostProcess(TestCase):
+    """
+    Tests for post_process against small generated trees
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+        self.source = CountingFileSystemStorage(os.path.join(self.tmpdir, 'src'))
+        self.settings = override_settings(
+            STATIC_CACHE_FILE=os.path.join(self.tmpdir, 'static.json'),
+            STATIC_ROOT=os.path.join(self.tmpdir, 'root'))
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    def make_tree(self, files):
+        for name, content in files.items():
+            if self.source.exists(name):
+                with open(self.source.path(name), 'rb') as source_file:
+                    if source_file.read() == content:
+                        continue
+                self.source.delete(name)
+            self.source.save(name, ContentFile(content))
+        return dict((name, (self.source, name)) for name in files)
+
+    def post_process(self, files, storage_class=HashedFilesStorage):
+        paths = self.make_tree(files)
+        storage = storage_class()
+        for name in paths:
+            if storage.exists(name):
+                storage.delete(name)
+            storage.save(name, self.source.open(name))
+        self.source.opened = 0
+        self.processed = set(name for name, hashed_name, processed
+                             in storage.post_process(paths) if processed)
+        results = dict((name, storage.cache.get(storage.cache_key(name)))
+                       for name in paths)
+        return storage, results
+
+    def test_sort_references(self):
+        levels = sort_references({
+            'a.css': set(['b.css', 'c.png']),
+            'b.css': set(['c.png']),
+            'c.png': set(),
+            'd.css': set(['e.css']),
+            'e.css': set(['d.css']),
+        })
+        self.assertEqual(levels, [
+            [('c.png',), ('d.css', 'e.css')],
+            [('b.css',)],
+            [('a.css',)],
+        ])
+
+    def test_partition_references(self):
+        graph = {
+            'a.css': set(['b.css']),
+            'b.css': set(['c.png']),
+            'c.png': set(),
+            'd.css': set(['e.css']),
+            'e.css': set(['d.css']),
+            'f.js': set(),
+            'g.js': set(),
+            'h.txt': set(),
+        }
+        shards = partition_references(graph, 3, groups=[['f.js', 'g.js']])
+        self.assertEqual(shards, [
+            set(['a.css', 'b.css', 'c.png']),
+            set(['d.css', 'e.css', 'h.txt']),
+            set(['f.js', 'g.js']),
+        ])
+        self.assertEqual(partition_references(dict(reversed(graph.items())), 3,
+                                              groups=[['g.js', 'f.js']]), shards)
+
+    def test_hash_covers_rewritten_references(self):
+        files = {
+            'css/a.css': '@import url("b.css");',
+            'css/b.css': 'body { background: url(../img/c.png); }',
+            'img/c.png': 'png',
+        }
+        storage, first = self.post_process(files)
+        for name, hashed_name in first.items():
+            with storage.open(hashed_name) as hashed_file:
+                digest = hashlib.md5(hashed_file.read()).hexdigest()[:12]
+            self.assertIn(digest, hashed_name)
+        with storage.open(first['css/a.css']) as hashed_file:
+            self.assertIn(posixpath.basename(first['css/b.css']),
+                          hashed_file.read())
+        # a change deep down the tree changes the hash of every referrer
+        files['img/c.png'] = 'png2'
+        storage, second = self.post_process(files)
+        for name in files:
+            self.assertNotEqual(first[name], second[name])
+
+    def test_files_are_read_once(self):
+        files = {
+            'a.css': '@import url("b.css"); body { background: url(c.png); }',
+            'b.css': 'body { background: url(c.png); }',
+            'c.png': 'png',
+        }
+        storage, results = self.post_process(files,
+            storage_class=CountingHashedFilesStorage)
+        self.assertEqual(storage.opened, 0)
+
+    def test_url_resolutions_are_memoized(self):
+        files = {
+            'a.css': 'a { background: url(c.png) } b { background: url(c.png) }',
+            'b.css': 'a { background: url(c.png) } b { background: url("c.png") }',
+            'd/e.css': 'a { background: url(../c.png) }',
+            'c.png': 'png',
+        }
+        storage, results = self.post_process(files)
+        self.assertEqual(storage.url_resolution_stats, {'hits': 3, 'misses': 2})
+        self.assertEqual(storage.url_resolutions, None)
+        with storage.open(results['d/e.css']) as hashed_file:
+            self.assertIn('../' + results['c.png'], hashed_file.read())
+
+    @override_settings(STATICFILES_COPY_BUFFER_SIZE=1024)
+    def test_single_pass_copy(self):
+        files = {
+            'small.txt': 'small',
+            'media/large.bin': os.urandom(200 * 1024),
+        }
+        storage, results = self.post_process(files)
+        self.assertEqual(self.source.opened, 2)
+        for name, content in files.items():
+            with storage.open(results[name]) as hashed_file:
+                self.assertEqual(hashed_file.read(), content)
+            digest = hashlib.md5(content).hexdigest()[:12]
+            self.assertIn(digest, results[name])
+        # hashed files which exist already are left alone
+        storage, results = self.post_process(files)
+        self.assertEqual(self.processed, set())
+        self.assertEqual(sorted(os.listdir(storage.path('media'))),
+                         sorted(['large.bin', posixpath.basename(results['media/large.bin'])]))
+
+    @override_settings(STATICFILES_COMPRESS=True,
+                       STATICFILES_COMPRESS_FORMATS=('gz',))
+    def test_compressed_variants(self):
+        files = {
+            'css/a.css': 'body { color: red; }\n' * 100,
+            'b.txt': 'x',
+            'c.png': 'png ' * 100,
+        }
+        storage, results = self.post_process(files)
+        variant = results['css/a.css'] + '.gz'
+        self.assertEqual(storage.cache.get(storage.cache_key('css/a.css.gz')),
+                         variant)
+        with storage.open(variant) as gz_file:
+            compressed = gz_file.read()
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(),
+                         files['css/a.css'])
+        # too small to gain anything, and not a text asset
+        self.assertFalse(storage.exists(results['b.txt'] + '.gz'))
+        self.assertFalse(storage.exists(results['c.png'] + '.gz'))
+        self.assertEqual(storage.cache.get(storage.cache_key('b.txt.gz')), None)
+        # compression is deterministic, and existing variants are kept
+        modified = int(os.path.getmtime(storage.path(variant))) - 10
+        os.utime(storage.path(variant), (modified, modified))
+        storage, results = self.post_process(files)
+        self.assertEqual(os.path.getmtime(storage.path(variant)), modified)
+        self.assertEqual(storage.cache.get(storage.cache_key('css/a.css.gz')),
+                         variant)
+        self.assertEqual(gzip_compress(files['css/a.css']), compressed)
+
+    @override_settings(STATICFILES_PREFETCH_LISTING=True,
+                       STATICFILES_UPLOAD_WORKERS=4,
+                       STATICFILES_UPLOAD_RETRIES=1,
+                       STATICFILES_UPLOAD_BACKOFF=0.01)
+    def test_remote_storage(self):
+        files = dict(('img/%d.png' % i, 'png %d' % i) for i in range(20))
+        files['a.css'] = ''.join('a { background: url(img/%d.png) }' % i
+                                 for i in range(20))
+        storage, results = self.post_process(files, LatentHashedFilesStorage)
+        # one listing instead of an exists() round trip per file
+        self.assertEqual(storage.calls.get('exists'), None)
+        self.assertEqual(storage.calls['listdir'], 2)
+        self.assertEqual(storage.calls['save'], 21)
+        self.assertTrue(1 < storage.max_uploading <= 4)
+        for name, content in files.items():
+            if name.endswith('.png'):
+                with storage.open(results[name]) as hashed_file:
+                    self.assertEqual(hashed_file.read(), content)
+        with storage.open(results['a.css']) as hashed_file:
+            self.assertIn(posixpath.basename(results['img/7.png']),
+                          hashed_file.read())
+
+        # a failed save is retried
+        files['b.txt'] = 'b'
+        LatentHashedFilesStorage.post_process_failures = {'b.': 1}
+        self.addCleanup(setattr, LatentHashedFilesStorage,
+                        'post_process_failures', {})
+        storage, results = self.post_process(files, LatentHashedFilesStorage)
+        with storage.open(results['b.txt']) as hashed_file:
+            self.assertEqual(hashed_file.read(), 'b')
+
+        # and a save failing every time fails post_process, before the
+        # manifest is written
+        files['c.txt'] = 'c'
+        LatentHashedFilesStorage.post_process_failures = {'c.': 2}
+        self.assertRaises(IOError, self.post_process, files,
+                          LatentHashedFilesStorage)
+        self.assertEqual(HashedFilesStorage().cache.get(
+            storage.cache_key('c.txt')), None)
+
+    @override_settings(STATICFILES_UPLOAD_WORKERS=2,
+                       STATICFILES_COMPRESS=True,
+                       STATICFILES_COMPRESS_FORMATS=('gz',))
+    def test_remote_compressed_variants(self):
+        files = {'a.js': 'var a = 1;\n' * 100}
+        storage, results = self.post_process(files,
+                                             SlowUploadHashedFilesStorage)
+        # the variant is compressed once the file is uploaded
+        variant = storage.cache.get(storage.cache_key('a.js.gz'))
+        self.assertEqual(variant, results['a.js'] + '.gz')
+        with storage.open(variant) as gz_file:
+            self.assertEqual(gzip.GzipFile(fileobj=gz_file).read(),
+                             files['a.js'])
+
+    @override_settings(STATICFILES_HASH_ALGORITHM='sha256',
+                       STATICFILES_HASH_LENGTH=16,
+                       STATICFILES_INTEGRITY_ALGORITHM='sha384',
+                       STATICFILES_INCREMENTAL=True)
+    def test_digests(self):
+        files = {
+            'a.css': 'body { background: url(b.png) }',
+            'b.png': 'png',
+        }
+        storage, results = self.post_process(files)
+        self.assertEqual(results['b.png'],
+                         'b.%s.png' % hashlib.sha256('png').hexdigest()[:16])
+        for name in files:
+            with storage.open(results[name]) as hashed_file:
+                content = hashed_file.read()
+            integrity = 'sha384-' + base64.b64encode(hashlib.sha384(content).digest())
+            self.assertEqual(storage.integrity(name), integrity)
+            self.assertEqual(storage.cache.get(storage.integrity_key(name)),
+                             integrity)
+        staticfiles_storage._wrapped = storage
+        self.addCleanup(setattr, staticfiles_storage, '_wrapped', empty)
+        template = loader.get_template_from_string(
+            "{% load staticstorages %}{% static_integrity 'b.png' %}")
+        self.assertEqual(template.render(Context()), storage.integrity('b.png'))
+        # unchanged files keep their integrity values
+        storage, results = self.post_process(files)
+        self.assertEqual(self.processed, set())
+        self.assertEqual(HashedFilesStorage().integrity('b.png'),
+                         storage.integrity('b.png'))
+        # and files which are not in the manifest get them on demand
+        integrity = storage.integrity('b.png')
+        storage.cache.clear()
+        self.assertEqual(storage.integrity('b.png'), integrity)
+
+    def test_digest_cache(self):
+        self.make_tree({'a.txt': 'a'})
+        storage = HashedFilesStorage()
+        path = self.source.path('a.txt')
+        with self.source.open('a.txt') as f:
+            self.assertEqual(storage.file_hash(f), hashlib.md5('a').hexdigest())
+        # recently modified files are not cached, their mtime may not change
+        self.assertEqual(storage.digests, {})
+        os.utime(path, (time.time() - 10, time.time() - 10))
+        with self.source.open('a.txt') as f:
+            storage.file_hash(f)
+        self.assertEqual(storage.digests.values(),
+                         [(hashlib.md5('a').hexdigest(), None)])
+        storage.digests[storage.digests.keys()[0]] = ('cached', None)
+        with self.source.open('a.txt') as f:
+            self.assertEqual(storage.file_hash(f), 'cached')
+        os.utime(path, (time.time() - 5, time.time() - 5))
+        with self.source.open('a.txt') as f:
+            self.assertEqual(storage.file_hash(f), hashlib.md5('a').hexdigest())
+
+    def test_deduplicate(self):
+        files = {
+            'app1/lib.js': 'lib',
+            'app2/lib.js': 'lib',
+            'app2/img/icon.png': 'png',
+            'img/icon.png': 'png',
+            'app1/a.css': '.a { background: url(../img/icon.png) }',
+            'app2/a.css': '.a { background: url(img/icon.png) }',
+        }
+        for mode in ('hardlink', 'symlink'):
+            with override_settings(STATICFILES_DEDUPLICATE=mode):
+                shutil.rmtree(os.path.join(self.tmpdir, 'root'), ignore_errors=True)
+                storage, results = self.post_process(files)
+            for name in ('app1/lib.js', 'app2/lib.js'):
+                with storage.open(results[name]) as hashed_file:
+                    self.assertEqual(hashed_file.read(), 'lib')
+            stat1 = os.lstat(storage.path(results['app1/lib.js']))
+            stat2 = os.lstat(storage.path(results['app2/lib.js']))
+            if mode == 'hardlink':
+                self.assertEqual(stat1.st_ino, stat2.st_ino)
+            else:
+                self.assertNotEqual(os.path.islink(storage.path(results['app1/lib.js'])),
+                                    os.path.islink(storage.path(results['app2/lib.js'])))
+
+        with override_settings(STATICFILES_DEDUPLICATE='alias'):
+            shutil.rmtree(os.path.join(self.tmpdir, 'root'), ignore_errors=True)
+            storage, results = self.post_process(files)
+        icon = results['app2/img/icon.png']
+        self.assertEqual(results['img/icon.png'], icon)
+        self.assertEqual(len(os.listdir(storage.path('app2/img')) +
+                             os.listdir(storage.path('img'))), 3)
+        # processed files are never aliased, their relative URLs only
+        # work from their own directory
+        self.assertNotEqual(results['app1/lib.js'], results['app2/lib.js'])
+        # references to a file aliased to another directory are absolute
+        relative = 'url("img/%s")' % posixpath.basename(icon)
+        absolute = 'url("/static/%s")' % icon
+        with storage.open(results['app1/a.css']) as hashed_file:
+            app1_css = hashed_file.read()
+        with storage.open(results['app2/a.css']) as hashed_file:
+            app2_css = hashed_file.read()
+        if icon.startswith('img/'):
+            self.assertIn('url("../%s")' % icon, app1_css)
+            self.assertIn(absolute, app2_css)
+        else:
+            self.assertIn(absolute, app1_css)
+            self.assertIn(relative, app2_css)
+
+    @override_settings(STATICFILES_DEDUPLICATE='hardlink',
+                       STATICFILES_UPLOAD_WORKERS=2)
+    def test_remote_deduplicate(self):
+        files = {'app1/lib.js': 'lib', 'app2/lib.js': 'lib'}
+        storage, results = self.post_process(files,
+                                             SlowUploadHashedFilesStorage)
+        # linked once the first copy is uploaded
+        stat1 = os.stat(storage.path(results['app1/lib.js']))
+        stat2 = os.stat(storage.path(results['app2/lib.js']))
+        self.assertEqual(stat1.st_ino, stat2.st_ino)
+        self.assertEqual(stat1.st_size, 3)
+
+    @override_settings(STATICFILES_INCREMENTAL=True)
+    def test_incremental(self):
+        files = {
+            'a.css': '@import url("b.css");',
+            'b.css': 'body { background: url(c.png); }',
+            'c.png': 'png',
+            'd.txt': 'txt',
+        }
+        storage, first = self.post_process(files)
+        self.assertEqual(self.processed, set(files))
+        storage, second = self.post_process(files)
+        self.assertEqual(second, first)
+        self.assertEqual(self.processed, set())
+        self.assertEqual(self.source.opened, 0)
+        files['c.png'] = 'png2'
+        storage, third = self.post_process(files)
+        self.assertEqual(self.processed, set(['a.css', 'b.css', 'c.png']))
+        self.assertEqual(third['d.txt'], first['d.txt'])
+        self.assertNotEqual(third['a.css'], first['a.css'])
+        # other hashes make other names of the same sources
+        with override_settings(STATICFILES_HASH_ALGORITHM='sha256',
+                               STATICFILES_HASH_LENGTH=16):
+            storage, fourth = self.post_process(files)
+        self.assertEqual(self.processed, set(files))
+        self.assertEqual(fourth['d.txt'],
+                         'd.%s.txt' % hashlib.sha256('txt').hexdigest()[:16])
+        with storage.open(fourth['a.css']) as hashed_file:
+            self.assertIn(fourth['b.css'], hashed_file.read())
+
+    def test_reference_cycle(self):
+        files = {
+            'a.css': '@import url("b.css");',
+            'b.css': '@import url("a.css");',
+        }
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            storage, results = self.post_process(files)
+        self.assertEqual([w.category for w in caught], [CyclicReferenceWarning])
+        for name, hashed_name in results.items():
+            self.assertTrue(storage.exists(hashed_name))
+        with storage.open(results['a.css']) as hashed_file:
+            self.assertIn(results['b.css'], hashed_file.read())
+
+    @override_settings(STATICFILES_INLINE_MAX_SIZE=16, STATICFILES_STATS=True,
+                       STATICFILES_INCREMENTAL=True)
+    def test_inline_data_uris(self):
+        files = {
+            'css/a.css': 'a { background: url(../img/dot.png) }\n'
+                         'b { background: url("../img/big.png") }\n'
+                         'c { background: url(../img/dot.png?v=1) }\n'
+                         'd { background: url(../img/copy.png) }\n'
+                         'e { background: url(../img/font.woff) }',
+            'js/a.js': 'var dot = \'url("../img/dot.png")\';',
+            'img/dot.png': 'dot',
+            'img/copy.png': 'dot',
+            'img/big.png': 'x' * 17,
+            'img/font.woff': 'woff',
+        }
+        storage, results = self.post_process(files)
+        dot_uri = 'data:image/png;base64,' + base64.b64encode('dot')
+        relative = lambda name: '../' + results[name]
+        with storage.open(results['css/a.css']) as hashed_file:
+            css = hashed_file.read()
+        self.assertEqual(css,
+            'a { background: url("%s") }\n'
+            'b { background: url("%s") }\n'
+            'c { background: url("%s?v=1") }\n'
+            'd { background: url("%s") }\n'
+            'e { background: url("%s") }' % (
+                dot_uri, relative('img/big.png'), relative('img/dot.png'),
+                dot_uri, relative('img/font.woff')))
+        with storage.open(results['js/a.js']) as hashed_file:
+            self.assertIn(relative('img/dot.png'), hashed_file.read())
+        # the same content is encoded once
+        self.assertEqual(storage.stats.counters['inline.files'], 1)
+
+        # a changed inlined file changes the hash of the file it is in
+        files['img/dot.png'] = 'dot2'
+        storage, second = self.post_process(files)
+        self.assertEqual(self.processed, set(['img/dot.png', 'css/a.css',
+                                              'js/a.js']))
+        self.assertNotEqual(second['css/a.css'], results['css/a.css'])
+        with storage.open(second['css/a.css']) as hashed_file:
+            self.assertIn(base64.b64encode('dot2'), hashed_file.read())
+
+    @override_settings(STATICFILES_INCREMENTAL=True)
+    def test_inlining_turned_on(self):
+        files = {
+            'a.css': 'a { background: url(b.png) }',
+            'b.png': 'png',
+        }
+        storage, results = self.post_process(files)
+        dot_uri = 'data:image/png;base64,' + base64.b64encode('png')
+        for inline_types in (('image/gif',), ('image/png',)):
+            with override_settings(STATICFILES_INLINE_MAX_SIZE=100,
+                                   STATICFILES_INLINE_TYPES=inline_types):
+                storage, results = self.post_process(files)
+            # b.png is hashed again to the name of its existing file
+            self.assertEqual(self.processed, set(['a.css']))
+        with storage.open(results['a.css']) as hashed_file:
+            self.assertEqual(hashed_file.read(),
+                             'a { background: url("%s") }' % dot_uri)
+
+    @override_settings(STATICFILES_INLINE_MAX_SIZE=16,
+                       STATICFILES_UPLOAD_WORKERS=2)
+    def test_remote_inline_data_uris(self):
+        files = {
+            'css/a.css': 'a { background: url(../img/dot.png) }',
+            'img/dot.png': 'dot',
+        }
+        storage, results = self.post_process(files,
+                                             SlowUploadHashedFilesStorage)
+        # encoded from the content post_process saved, not the queued upload
+        with storage.open(results['css/a.css']) as hashed_file:
+            self.assertEqual(hashed_file.read(), 'a { background: url("%s") }'
+                             % ('data:image/png;base64,' + base64.b64encode('dot')))
+
+    @override_settings(STATICFILES_INCREMENTAL=True, STATICFILES_BUNDLES={
+        'bundles/app.css': ['css/a.css', 'css/sub/b.css', 'c.css'],
+        'bundles/app.js': ['js/a.js', 'js/b.js'],
+    })
+    def test_bundles(self):
+        files = {
+            'css/a.css': 'a { background: url(../img/a.png) }',
+            'css/sub/b.css': 'b { background: url("../../img/b.png#x") }\n'
+                             'c { background: url(http://example.com/c.png) }',
+            'c.css': 'd { background: url(img/a.png) }',
+            'js/a.js': 'var a = 1',
+            'js/b.js': 'var b = \'url("../img/b.png")\';',
+            'img/a.png': 'a',
+            'img/b.png': 'b',
+        }
+        storage, results = self.post_process(files)
+        hashed_css = storage.cache.get(storage.cache_key('bundles/app.css'))
+        hashed_js = storage.cache.get(storage.cache_key('bundles/app.js'))
+        self.assertEqual(storage.url('bundles/app.css'), '/static/' + hashed_css)
+        self.assertTrue(hashed_css.startswith('bundles/app.'))
+        self.assertIn('bundles/app.js', self.processed)
+        with storage.open(hashed_css) as bundle_file:
+            css = bundle_file.read()
+        self.assertIn(hashlib.md5(css).hexdigest()[:12], hashed_css)
+        self.assertEqual(css,
+            'a { background: url("../%s") }\n'
+            'b { background: url("../%s#x") }\n'
+            'c { background: url("http://example.com/c.png") }\n'
+            'd { background: url("../%s") }' % (
+                results['img/a.png'], results['img/b.png'], results['img/a.png']))
+        with storage.open(hashed_js) as bundle_file:
+            self.assertEqual(bundle_file.read(),
+                'var a = 1;\nvar b = "../%s";' % results['img/b.png'])
+
+        # unchanged files are read back from the storage
+        files['js/a.js'] = 'var a = 22'
+        storage, second = self.post_process(files)
+        self.assertEqual(self.processed, set(['js/a.js', 'bundles/app.js']))
+        self.assertEqual(
+            storage.cache.get(storage.cache_key('bundles/app.css')), hashed_css)
+        with storage.open(storage.cache.get(
+                storage.cache_key('bundles/app.js'))) as bundle_file:
+            self.assertTrue(bundle_file.read().startswith('var a = 22;\n'))
+
+    @override_settings(STATICFILES_BUNDLES={'app.js': ['a.js', 'missing.js']})
+    def test_bundle_of_missing_file(self):
+        self.assertRaises(ValueError, self.post_process, {'a.js': 'a'})
+
+    @override_settings(STATICFILES_COMPRESS=True, STATICFILES_GENERATIONS=1,
+                       STATICFILES_INTEGRITY_ALGORITHM='sha384',
+                       STATICFILES_DEDUPLICATE='alias',
+                       STATICFILES_BUNDLES={'all.js': ['js/app.js', 'js/lib.js']})
+    def test_sharded_post_process(self):
+        files = {
+            'css/a.css': '@import url("b.css");' + ' ' * 200,
+            'css/b.css': 'body { background: url(../img/c.png); }',
+            'img/c.png': 'c',
+            'x.css': '@import url("y.css");',
+            'y.css': '@import url("x.css");',
+            'js/app.js': 'var e = \'url("../img/e.png")\';',
+            'js/lib.js': 'var lib;',
+            'img/e.png': 'e',
+            'f.txt': 'f',
+            'g.txt': 'g',
+        }
+        files.update(('d%d/icon.png' % i, 'icon') for i in range(6))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            storage, results = self.post_process(files)
+        # duplicates are aliased to the smallest of their hashed names
+        self.assertEqual(set(results[name] for name in files
+                             if name.endswith('icon.png')),
+                         set([storage.hashed_name('d0/icon.png')]))
+        with open(storage.cache.filename, 'rb') as manifest_file:
+            manifest = manifest_file.read()
+        with open(storage.history_filename, 'rb') as history_file:
+            names = json.load(history_file)[0]['names']
+        saved = storage._list_all()
+
+        # the same files post-processed by three processes sharing a root
+        root = os.path.join(self.tmpdir, 'sharded')
+        paths = dict((name, (self.source, name)) for name in files)
+        with override_settings(STATIC_ROOT=root, STATIC_CACHE_FILE=os.path.join(
+                self.tmpdir, 'sharded.json')):
+            storage = HashedFilesStorage()
+            for name in files:
+                storage.save(name, self.source.open(name))
+            processes = [multiprocessing.Process(target=post_process_shard,
+                                                 args=(paths, (index, 3)))
+                         for index in range(3)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            self.assertEqual([process.exitcode for process in processes], [0] * 3)
+            storage.merge_shards(3)
+            with open(storage.cache.filename, 'rb') as manifest_file:
+                self.assertEqual(manifest_file.read(), manifest)
+            with open(storage.history_filename, 'rb') as history_file:
+                self.assertEqual(json.load(history_file)[0]['names'], names)
+            self.assertEqual(storage._list_all(), saved)
+            self.assertEqual(storage.url('all.js'), '/static/' +
+                             storage.cache.get(storage.cache_key('all.js')))
+            self.assertFalse(os.path.exists(storage.shard_filename(0, 3)))
+            self.assertRaises(ValueError, storage.merge_shards, 3)
+
+    @override_settings(STATICFILES_GENERATIONS=2)
+    def test_prune(self):
+        files = {
+            'a.css': 'a { background: url(b.png) }',
+            'b.png': 'b1',
+            'lib.0123456789ab.js': 'lib',
+        }
+        self.assertRaises(ValueError, list, HashedFilesStorage().prune())
+        storage, first = self.post_process(files)
+        files['b.png'] = 'b22'
+        storage, second = self.post_process(files)
+        files['b.png'] = 'b333'
+        storage, third = self.post_process(files)
+        history = GenerationHistory(storage.history_filename)
+        self.assertEqual(len(history), 2)
+        self.assertEqual(history[-1]['names'],
+                         sorted(files.keys() + third.values()))
+        storage.save(first['a.css'] + '.gz', ContentFile('gz'))
+        stale = set([first['a.css'], first['a.css'] + '.gz', first['b.png']])
+
+        self.assertEqual(list(storage.prune(min_age=3600)), [])
+        self.assertEqual(set(storage.prune(dry_run=True)), stale)
+        self.assertTrue(all(storage.exists(name) for name in stale))
+        self.assertEqual(set(storage.prune(batch_size=1)), stale)
+        self.assertFalse(any(storage.exists(name) for name in stale))
+        self.assertEqual(set(storage.prune(keep=1)),
+                         set([second['a.css'], second['b.png']]))
+        for name in files.keys() + third.values():
+            self.assertTrue(storage.exists(name))
+
+    @override_settings(STATICFILES_COPY_BUFFER_SIZE=256,
+                       STATICFILES_STREAM_OVERLAP=64)
+    def test_streamed_processing(self):
+        rules = ''.join('.c%d { background: url(img/c.png); }\n' % i
+                        for i in range(500))
+        files = {'a.css': rules, 'img/c.png': 'png'}
+        storage, results = self.post_process(files)
+        with storage.open(results['a.css']) as hashed_file:
+            content = hashed_file.read()
+        self.assertEqual(content, rules.replace(
+            'url(img/c.png)', 'url("%s")' % results['img/c.png']))
+        self.assertIn(hashlib.md5(content).hexdigest()[:12], results['a.css'])
+        # no temporary files are left behind
+        self.assertEqual([name for name in os.listdir(storage.path(''))
+                          if name.startswith('.')], [])
+
+    @override_settings(STATICFILES_URL_TABLE=True)
+    def test_lazy_manifest(self):
+        storage, results = self.post_process({'a.css': 'a {}', 'b.txt': 'b'})
+        storage = HashedFilesStorage()
+        self.assertEqual(storage._cache, None)
+        self.assertEqual(storage._url_table, None)
+        self.assertEqual(storage.url('a.css'), '/static/' + results['a.css'])
+        self.assertNotEqual(storage._cache, None)
+
+        storage = HashedFilesStorage()
+        storage.warm()
+        self.assertNotEqual(storage._cache, None)
+        self.assertEqual(storage._url_table,
+                         {'a.css': '/static/' + results['a.css'],
+                          'b.txt': '/static/' + results['b.txt']})
+        for processor in storage.processors:
+            self.assertIn('_scanner', type(processor).__dict__)
+
+
+class FakeBackend(object):
+    def url(self, name, force=False):
+        root, ext = posixpath.splitext(name)
+        return '/static/%s.hashed%s' % (root, ext)
+
+
+class TestProcessors(TestCase):
+    """
+    Tests for the processors' rewriting rules
+    """
+    def test_rules_are_applied_in_one_pass(self):
+        class UpperProcessor(BaseProcessor):
+            rules = (
+                (r'(?P<q>["\'])(?P<url>a+)(?P=q)', 'upper'),
+                (r'(?P<q><)(?P<url>b+)>', 'upper'),
+            )
+
+            def upper(self, name, match):
+                return match.group('url').upper()
+
+        processor = UpperProcessor(FakeBackend())
+        self.assertEqual(processor.process('x', '"aa" <bb> "bb" \'a\''),
+                         'AA BB "bb" A')
+        self.assertEqual(list(processor.find_urls('"aa" <bb>')), ['aa', 'bb'])
+
+    def test_css(self):
+        processor = CssProcessor(FakeBackend())
+        content = processor.process('css/a.css',
+            '@import "b.css";\n'
+            '@import url( \'../c.css\' );\n'
+            'a { background: url(img/d e.png) }\n'
+            'b { background: url("data:image/png;base64,AAAA") }')
+        self.assertEqual(content,
+            '@import "b.hashed.css";\n'
+            '@import url("../c.hashed.css");\n'
+            'a { background: url("img/d e.hashed.png") }\n'
+            'b { background: url("data:image/png;base64,AAAA") }')
+
+    def test_js(self):
+        processor = JsProcessor(FakeBackend())
+        content = processor.process('js/app.js',
+            'var smile = \'url("../img/smile.png")\';')
+        self.assertEqual(content, 'var smile = "../img/smile.hashed.png";')
+
+    def test_js_template_is_read_on_first_use(self):
+        class TemplateProcessor(JsProcessor):
+            pass
+
+        with override_settings(
+                STATIC_JSPROCESSOR_TEMPLATE=r"STATIC\('(?P<content>[^']*)'\)"):
+            processor = TemplateProcessor(FakeBackend())
+            self.assertEqual(processor.process('js/app.js',
+                "var smile = STATIC('../img/smile.png');"),
+                'var smile = "../img/smile.hashed.png";')
+
+    def test_source_maps(self):
+        processor = SourceMapProcessor(FakeBackend())
+        self.assertEqual(processor.process('js/a.js',
+            'var a;\n//# sourceMappingURL=a.js.map\n'),
+            'var a;\n//# sourceMappingURL=a.js.hashed.map\n')
+        self.assertEqual(processor.process('css/a.css',
+            'a {}\n/*# sourceMappingURL=maps/a.css.map */'),
+            'a {}\n/*# sourceMappingURL=maps/a.css.hashed.map */')
+
+    def test_dispatch(self):
+        class MinProcessor(BaseProcessor):
+            filepatterns = ('*.min.js', 'vendor/*')
+
+        class LegacyProcessor(BaseProcessor):
+            filepattern = '*.JS'
+
+        processors = [JsProcessor(FakeBackend()), SourceMapProcessor(FakeBackend()),
+                      CssProcessor(FakeBackend()), MinProcessor(FakeBackend()),
+                      LegacyProcessor(FakeBackend())]
+        js, maps, css, minified, legacy = processors
+        index = ProcessorIndex(processors)
+        self.assertEqual(index.lookup('img/a.png'), None)
+        self.assertEqual(index.lookup('a.css.png'), None)
+        self.assertEqual(index.lookup('vendor/a.png'), minified)
+        self.assertEqual(index.lookup('A.JS'), legacy)
+        self.assertEqual(index.lookup('css/a.css').processors, [maps, css])
+        self.assertEqual(index.lookup('js/a.min.js').processors,
+                         [js, maps, minified])
+        self.assertTrue(index.lookup('a.js') is index.lookup('b/c.js'))
+        self.assertEqual(index.lookup('css/a.css').process('css/a.css',
+            'a { background: url(b.png) }\n/*# sourceMappingURL=a.css.map */'),
+            'a { background: url("b.hashed.png") }\n'
+            '/*# sourceMappingURL=a.css.hashed.map */')
+
+    @override_settings(STATICFILES_STREAM_OVERLAP=32)
+    def test_process_chunks(self):
+        content = ''.join(
+            'a%d { background: url( "../img/%d.png" ) }\n'
+            'var b%d = \'url("img/%d.png")\';\n' % (i, i, i, i)
+            for i in range(50))
+        chain = ProcessorChain([CssProcessor(FakeBackend()),
+                                JsProcessor(FakeBackend())])
+        expected = chain.process('a.css', content)
+        for size in (1, 7, 64, 1000, len(content)):
+            chunks = [content[i:i + size] for i in range(0, len(content), size)]
+            self.assertEqual(''.join(chain.process_chunks('a.css', chunks)),
+                             expected)
+
+    def test_no_catastrophic_backtracking(self):
+        content = ('url(' + ' ' * 20000 + 'x' + ' ' * 20000 +
+                   '@import "' + ' a' * 20000 + "'url(\"" * 20000)
+        for processor in (CssProcessor(FakeBackend()), JsProcessor(FakeBackend())):
+            self.assertEqual(processor.process('a', content), content)
+
+
+class TestHashedCache(TestCase):
+    """
+    Tests for the journaled manifest persistence
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+        self.filename = os.path.join(self.tmpdir, 'static.json')
+
+    def make_cache(self, **options):
+        options.setdefault('STATIC_CACHE_FILE', self.filename)
+        with override_settings(**options):
+            return HashedCache()
+
+    def test_misses_are_journaled_in_batches(self):
+        cache = self.make_cache(STATIC_CACHE_FLUSH_SIZE=2)
+        cache.set('a', 'a.1.css')
+        self.assertFalse(os.path.exists(cache.journal_filename))
+        cache.set('b', 'b.2.css')
+        self.assertTrue(os.path.exists(cache.journal_filename))
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual(self.make_cache().get('b'), 'b.2.css')
+
+    def test_torn_journal_line_is_ignored(self):
+        cache = self.make_cache(STATIC_CACHE_FLUSH_SIZE=1)
+        cache.set('a', 'a.1.css')
+        with open(cache.journal_filename, 'a') as jf:
+            jf.write('{"b": "b.2')
+        reloaded = self.make_cache()
+        self.assertEqual(reloaded.get('a'), 'a.1.css')
+        self.assertEqual(reloaded.get('b'), None)
+
+    def test_journal_is_compacted(self):
+        cache = self.make_cache(STATIC_CACHE_FLUSH_SIZE=1,
+                                STATIC_CACHE_COMPACT_SIZE=2)
+        for key in 'abc':
+            cache.set(key, key + '.css')
+        self.assertFalse(os.path.exists(cache.journal_filename))
+        with open(self.filename) as sf:
+            self.assertEqual(len(json.load(sf)), 3)
+        self.assertEqual([filename for filename in os.listdir(self.tmpdir)
+                          if not filename.endswith('.lock')], ['static.json'])
+
+    def test_compaction_keeps_entries_journaled_by_others(self):
+        cache = self.make_cache(STATIC_CACHE_FLUSH_SIZE=1,
+                                STATIC_CACHE_COMPACT_SIZE=1)
+        other = self.make_cache(STATIC_CACHE_FLUSH_SIZE=1)
+        other.set('a', 'a.css')
+        cache.set('b', 'b.css')
+        cache.set('c', 'c.css')
+        with open(self.filename) as sf:
+            self.assertEqual(sorted(json.load(sf)), ['a', 'b', 'c'])
+
+    def test_nothing_is_written_while_dirty(self):
+        cache = self.make_cache(STATIC_CACHE_FLUSH_SIZE=1,
+                                STATIC_CACHE_COMPACT_SIZE=0)
+        cache.set_many({'a': 'a.css'})
+        cache.clear()
+        cache.set('b', 'b.css')
+        cache.flush()
+        self.assertFalse(os.path.exists(cache.journal_filename))
+        with open(self.filename) as sf:
+            self.assertEqual(json.load(sf), {'a': 'a.css'})
+        self.assertEqual(cache.get('b'), 'b.css')
+        cache.set_many({'c': 'c.css'})
+        with open(self.filename) as sf:
+            self.assertEqual(json.load(sf), {'b': 'b.css', 'c': 'c.css'})
+
+    def test_replaced_manifest_is_reloaded(self):
+        cache = self.make_cache(STATIC_CACHE_RELOAD_INTERVAL=0)
+        cache.set_many({'a': 'a.1.css'})
+        version = cache.version
+        self.make_cache().set_many({'a': 'a.2.css'})
+        self.assertEqual(cache.get('a'), 'a.2.css')
+        self.assertTrue(cache.version > version)
+        # no reload while entries only live in memory
+        cache.update({'b': 'b.css'})
+        self.make_cache().set_many({'a': 'a.3.css'})
+        self.assertEqual(cache.get('a'), 'a.2.css')
+
+    def test_reload_is_throttled(self):
+        cache = self.make_cache(STATIC_CACHE_RELOAD_INTERVAL=3600)
+        cache.set_many({'a': 'a.1.css'})
+        self.make_cache().set_many({'a': 'a.2.css'})
+        self.assertEqual(cache.get('a'), 'a.1.css')
+        cache.next_check = 0
+        self.assertEqual(cache.get('a'), 'a.2.css')
+
+    def test_misses_against_replaced_manifest_are_dropped(self):
+        cache = self.make_cache(STATIC_CACHE_FLUSH_SIZE=1,
+                                STATIC_CACHE_RELOAD_INTERVAL=None)
+        self.make_cache().set_many({'a': 'a.2.css'})
+        cache.set('b', 'b.1.css')
+        self.assertFalse(os.path.exists(cache.journal_filename))
+        self.assertEqual(cache.get('a'), 'a.2.css')
+        self.assertEqual(cache.get('b'), None)
+
+    def test_binary_manifest(self):
+        keys = dict(('staticfiles:%s' % hashlib.md5(str(i)).hexdigest(),
+                     u'file.%d.css' % i) for i in range(100))
+        cache = self.make_cache(STATIC_CACHE_FORMAT='binary')
+        cache.set_many(keys)
+        self.assertTrue(isinstance(cache.data, ManifestIndex))
+        self.assertEqual(dict(cache.items()), keys)
+        reloaded = self.make_cache()
+        self.assertTrue(isinstance(reloaded.data, ManifestIndex))
+        for key, value in keys.items():
+            self.assertEqual(reloaded.get(key), value)
+        self.assertEqual(reloaded.get('staticfiles:%s' % ('0' * 32)), None)
+        self.assertEqual(reloaded.get('not a cache key'), None)
+        self.assertEqual(dict(reloaded.items()), keys)
+
+    def test_json_export_and_import(self):
+        key = 'staticfiles:%s' % hashlib.md5('styles.css').hexdigest()
+        cache = self.make_cache(STATIC_CACHE_FORMAT='binary')
+        cache.set_many({key: u'styles.1.css'})
+        exported = os.path.join(self.tmpdir, 'exported.json')
+        cache.export_json(exported)
+        cache.clear()
+        cache.import_json(exported)
+        self.assertEqual(self.make_cache().get(key), u'styles.1.css')
+
+
+class ManifestBackendTests(object):
+    """
+    Tests shared by the manifest backends
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+        self.filename = os.path.join(self.tmpdir, 'static.sqlite3')
+
+    def make_cache(self, **options):
+        options.setdefault('STATIC_CACHE_FILE', self.filename)
+        with override_settings(**options):
+            return self.backend()
+
+    def test_get_many_and_set_many(self):
+        cache = self.make_cache()
+        cache.set_many({'a': u'a.1.css', 'b': u'b.1.css'})
+        self.assertEqual(cache.get_many(['a', 'b', 'c']),
+                         {'a': u'a.1.css', 'b': u'b.1.css'})
+        self.assertEqual(cache.get('c'), None)
+        self.assertEqual(dict(self.make_cache().items()),
+                         {'a': u'a.1.css', 'b': u'b.1.css'})
+
+    def test_misses_are_shared(self):
+        cache = self.make_cache()
+        cache.set('a', u'a.1.css')
+        self.assertEqual(self.make_cache().get('a'), u'a.1.css')
+
+    def test_replaced_manifest_is_reloaded(self):
+        cache = self.make_cache(STATIC_CACHE_RELOAD_INTERVAL=0)
+        cache.set_many({'a': u'a.1.css'})
+        version = cache.version
+        other = self.make_cache()
+        other.clear()
+        # the previous manifest is used until the new one is stored
+        self.assertEqual(cache.get('a'), u'a.1.css')
+        self.assertEqual(other.get('a'), None)
+        other.update({'b': u'b.2.css'})
+        other.set_many({'a': u'a.2.css'})
+        self.assertEqual(cache.get_many(['a', 'b']),
+                         {'a': u'a.2.css', 'b': u'b.2.css'})
+        self.assertTrue(cache.version > version)
+
+
+class TestDjangoCacheHashedCache(ManifestBackendTests, TestCase):
+    backend = DjangoCacheHashedCache
+
+    def setUp(self):
+        super(TestDjangoCacheHashedCache, self).setUp()
+        get_cache('default').clear()
+
+    def test_keys_are_chunked(self):
+        cache = self.make_cache()
+        cache.keys_chunk_size = 2
+        values = dict((str(i), u'%d.css' % i) for i in range(5))
+        cache.set_many(values)
+        self.assertEqual(cache.cache.get(cache.make_key('keys')), 3)
+        self.assertEqual(dict(self.make_cache().items()), values)
+
+    def test_entries_outlive_the_cache_timeout(self):
+        cache = self.make_cache()
+        cache.set_many({'a': u'a.1.css'})
+        expiry = cache.cache._expire_info[
+            cache.cache.make_key(cache.make_key('a'))]
+        self.assertTrue(expiry > time.time() + 365 * 24 * 60 * 60)
+
+
+class TestSqliteHashedCache(ManifestBackendTests, TestCase):
+    backend = SqliteHashedCache
+
+
 if __name__ == '__main__':
     import os
     sys.path.append('..')